@@ -0,0 +1,310 @@
+# encoding=utf-8
+# 基于仓库自带测试图片的压测脚本
+# 按指定并发数和时长压测各接口，输出吞吐、p50/p95/p99延迟以及服务进程的CPU/内存占用，
+# 结果写入json文件，可通过--compare与上一次的结果对比
+#
+# 下载/解密/语音代理类接口依赖的外部服务由脚本内置的本地替身服务模拟，压测时服务端需指向替身服务：
+# python ocr_server.py --ocr --det --genshin-host http://127.0.0.1:9911 --modelscope-host http://127.0.0.1:9911
+# python bench_api.py --host http://127.0.0.1:9898 --concurrency 8 --duration 10 --pid <服务进程pid> --output bench.json
+import argparse
+import base64
+import io
+import json
+import os
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CG_KEY = b'f5d965df75336270'
+CG_IV = b'97b60394abc2fbe1'
+AES_KEY = '0123456789abcdef'
+AES_IV = 'fedcba9876543210'
+
+
+def read_fixture(name):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+        return f.read()
+
+
+def make_wav(seconds=1, rate=16000):
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b'\x00\x00' * rate * seconds)
+    return buf.getvalue()
+
+
+def build_stub_files(rar_path=''):
+    # 替身服务提供的文件：jm图片、51cg及aes加密图片、rar压缩包、语音合成结果
+    img = read_fixture('test.jpg')
+    ecb_plain = ('data:image/jpeg;base64,' + base64.b64encode(img).decode()).encode()
+    files = {
+        '/media/photos/421536/00002.jpg': img,
+        '/51cg.jpg': AES.new(CG_KEY, AES.MODE_CBC, iv=CG_IV).encrypt(pad(img, AES.block_size)),
+        '/aes_cbc.jpg': AES.new(AES_KEY.encode(), AES.MODE_CBC, iv=AES_IV.encode()).encrypt(pad(img, AES.block_size)),
+        '/aes_ecb.txt': base64.b64encode(AES.new(AES_KEY.encode(), AES.MODE_ECB).encrypt(pad(ecb_plain, AES.block_size))),
+        '/audio.wav': make_wav(),
+    }
+    if rar_path:
+        with open(rar_path, 'rb') as f:
+            files['/archive.rar'] = f.read()
+    return files
+
+
+def start_stub_server(port, files):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # 服务端复用长连接时，头部与内容分两次写入会触发Nagle与延迟确认的40ms等待
+        disable_nagle_algorithm = True
+
+        def _send(self, data, content_type='application/octet-stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if '/file=' in path:
+                return self._send(files['/audio.wav'], 'audio/wav')
+            if path not in files:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self._send(files[path])
+
+        def do_POST(self):
+            # 模拟gradio的predict接口
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path.endswith('/run/predict'):
+                return self._send(json.dumps({"data": ["Success", {"name": "/tmp/audio.wav"}]}).encode(),
+                                  'application/json')
+            self.do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def build_scenarios(stub, has_rar=False):
+    # 每个场景返回 (method, path, kwargs)，kwargs直接传给requests
+    ocr_img = read_fixture('test.jpg')
+    calc_img = read_fixture('test_calc.png')
+    match_target, match_bg = read_fixture('match_target.png'), read_fixture('match_bg.png')
+    compare_target, compare_bg = read_fixture('compare_target.jpg'), read_fixture('compare_bg.jpg')
+    b64_json = base64.b64encode(json.dumps({'target_img': base64.b64encode(match_target).decode(),
+                                            'bg_img': base64.b64encode(match_bg).decode()}).encode()).decode()
+    scenarios = {
+        'ocr_file': ('POST', '/ocr/file', {'files': {'image': ocr_img}}),
+        'ocr_calc_file': ('POST', '/ocr/file', {'files': {'image': calc_img}}),
+        'ocr_b64': ('POST', '/ocr/b64', {'data': base64.b64encode(ocr_img).decode()}),
+        'det_file': ('POST', '/det/file/json', {'files': {'image': ocr_img}}),
+        'slide_match_file': ('POST', '/slide/match/file',
+                             {'files': {'target_img': match_target, 'bg_img': match_bg}}),
+        'slide_match_b64': ('POST', '/slide/match/b64', {'data': b64_json}),
+        'slide_compare_file': ('POST', '/slide/compare/file',
+                               {'files': {'target_img': compare_target, 'bg_img': compare_bg}}),
+        'jm': ('GET', '/jm', {'params': {'url': f'{stub}/media/photos/421536/00002.jpg'}}),
+        '51cg': ('GET', '/51cg', {'params': {'url': f'{stub}/51cg.jpg'}}),
+        'aes_cbc': ('GET', '/aesDecryptImg',
+                    {'params': {'url': f'{stub}/aes_cbc.jpg', 'key': AES_KEY, 'iv': AES_IV, 'mode': 'CBC'}}),
+        'aes_ecb': ('GET', '/aesDecryptImg',
+                    {'params': {'url': f'{stub}/aes_ecb.txt', 'key': AES_KEY, 'iv': AES_IV, 'mode': 'ECB'}}),
+        'genshininvoice': ('GET', '/genshininvoice',
+                           {'params': {'text': '你好', 'speaker': 'bench', 'sdp': 0.5, 'noise': 0.6,
+                                       'noise_w': 0.9, 'length': 1, 'language': 'auto', 'weight': 0.7,
+                                       'yuyi': ''}}),
+        'AIAudio': ('GET', '/AIAudio',
+                    {'params': {'text': '你好', 'speaker': 'taffy', 'sdp': 0.5, 'noise': 0.6, 'noise_w': 0.8,
+                                'length': 1}}),
+    }
+    if msgpack is not None:
+        scenarios['ocr_msgpack'] = ('POST', '/ocr/file/msgpack', {'data': msgpack.packb({'image': ocr_img}),
+                                                                  'headers': {'Content-Type': 'application/msgpack'}})
+    if has_rar:
+        scenarios['rar2zip'] = ('GET', '/rar2zip', {'params': {'rarurl': f'{stub}/archive.rar', 'filename': 'bench'}})
+    return scenarios
+
+
+class ProcessSampler(object):
+    # 采集服务进程的CPU时间与常驻内存，优先使用psutil，否则读取/proc
+    def __init__(self, pid):
+        self.pid = pid
+        self.process = psutil.Process(pid) if psutil is not None and pid else None
+
+    def cpu_seconds(self):
+        if self.process is not None:
+            times = self.process.cpu_times()
+            return times.user + times.system
+        if self.pid and os.path.exists(f'/proc/{self.pid}/stat'):
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        return None
+
+    def rss_mb(self):
+        if self.process is not None:
+            return round(self.process.memory_info().rss / 1024 / 1024, 1)
+        if self.pid and os.path.exists(f'/proc/{self.pid}/status'):
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return round(int(line.split()[1]) / 1024, 1)
+        return None
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return round(values[k] * 1000, 2)
+
+
+def is_error_body(resp):
+    # 接口出错时仍返回200，需要解析响应体：含code字段(error_ret)或msg非空(set_ret)即视为失败；图片、音频等二进制响应不解析
+    content_type = resp.headers.get('Content-Type', '')
+    try:
+        if 'json' in content_type:
+            body = resp.json()
+        elif 'msgpack' in content_type and msgpack is not None:
+            body = msgpack.unpackb(resp.content, raw=False)
+        else:
+            return False
+    except ValueError:
+        return True
+    if not isinstance(body, dict):
+        return False
+    return 'code' in body or bool(body.get('msg'))
+
+
+def run_scenario(host, scenario, concurrency, duration, sampler, deadline=0):
+    # deadline大于0时随请求发送X-Request-Timeout，并统计在截止时间内成功返回的有效吞吐
+    method, path, kwargs = scenario
+    if deadline > 0:
+        kwargs = dict(kwargs, headers=dict(kwargs.get('headers', {}), **{'X-Request-Timeout': str(deadline)}))
+    latencies = []
+    errors = [0]
+    good = [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def worker():
+        session = requests.Session()
+        local_latencies, local_errors, local_good = [], 0, 0
+        while time.time() < stop_at:
+            start = time.time()
+            try:
+                resp = session.request(method, host + path, timeout=60, **kwargs)
+                ok = resp.status_code == 200 and len(resp.content) > 0 and not is_error_body(resp)
+            except requests.RequestException:
+                ok = False
+            local_latencies.append(time.time() - start)
+            if not ok:
+                local_errors += 1
+            elif not deadline or local_latencies[-1] <= deadline:
+                local_good += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+            good[0] += local_good
+
+    cpu_before = sampler.cpu_seconds()
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+    cpu_after = sampler.cpu_seconds()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "goodput_rps": round(good[0] / elapsed, 2),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "server_cpu_percent": round((cpu_after - cpu_before) / elapsed * 100, 1) if cpu_before is not None else None,
+        "server_rss_mb": sampler.rss_mb(),
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    print(f"\n与{baseline_path}对比:")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        deltas = []
+        for key in ('throughput_rps', 'goodput_rps', 'p50_ms', 'p99_ms'):
+            if old.get(key) and result.get(key) is not None:
+                deltas.append(f"{key} {old[key]} -> {result[key]} ({(result[key] - old[key]) / old[key] * 100:+.1f}%)")
+        print(f"{name:20s} " + ', '.join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ocr_api_server压测脚本")
+    parser.add_argument("--host", default="http://127.0.0.1:9898")
+    parser.add_argument("--concurrency", type=int, default=4, help="每个场景的并发数")
+    parser.add_argument("--duration", type=float, default=10, help="每个场景的压测时长(秒)")
+    parser.add_argument("--routes", default="", help="只压测指定场景，逗号分隔，默认全部")
+    parser.add_argument("--stub-port", type=int, default=9911, help="本地替身服务端口")
+    parser.add_argument("--rar", default="", help="rar2zip场景使用的rar文件，不指定则跳过该场景")
+    parser.add_argument("--deadline", type=float, default=0,
+                        help="请求的截止时间(秒)，通过X-Request-Timeout发送，超时或被拒绝的请求不计入有效吞吐")
+    parser.add_argument("--pid", type=int, default=0, help="服务进程pid，用于采集CPU与内存")
+    parser.add_argument("--output", default="", help="结果输出的json文件")
+    parser.add_argument("--compare", default="", help="与之前输出的json结果对比")
+    args = parser.parse_args()
+
+    stub = f'http://127.0.0.1:{args.stub_port}'
+    start_stub_server(args.stub_port, build_stub_files(args.rar))
+    scenarios = build_scenarios(stub, bool(args.rar))
+    names = [name for name in args.routes.split(',') if name] or list(scenarios)
+    sampler = ProcessSampler(args.pid)
+
+    results = {}
+    for name in names:
+        results[name] = run_scenario(args.host, scenarios[name], args.concurrency, args.duration, sampler,
+                                     args.deadline)
+        r = results[name]
+        print(f"{name:20s} {r['throughput_rps']:>8} req/s  有效 {r['goodput_rps']} req/s  p50 {r['p50_ms']}ms  p95 {r['p95_ms']}ms  "
+              f"p99 {r['p99_ms']}ms  错误 {r['errors']}/{r['requests']}  "
+              f"CPU {r['server_cpu_percent']}%  RSS {r['server_rss_mb']}MB")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"host": args.host, "concurrency": args.concurrency, "duration": args.duration,
+                       "time": time.strftime('%Y-%m-%d %H:%M:%S'), "results": results},
+                      f, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
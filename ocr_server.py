@@ -1,111 +1,1943 @@
 # encoding=utf-8
+import sys
+
+if '--async' in sys.argv:
+    # gevent需要在其他模块导入之前打补丁，出站请求与文件读写才会变为非阻塞
+    from gevent import monkey
+
+    monkey.patch_all()
+
 import argparse
+import asyncio
 import base64
 import json
+import multiprocessing
+import queue
+import threading
 import time
 import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
 from urllib.parse import quote
 import hashlib
+import hmac
+import http.cookiejar
+import mimetypes
 import os
 import re
-from PIL import Image
+import shutil
+import struct
+import tempfile
+from PIL import Image, ImageDraw
 import ddddocr
+import onnxruntime
 import requests
+import edge_tts
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import rarfile
 import uuid
-from flask import Flask, request, jsonify, make_response, send_from_directory
+import wave
+from flask import Flask, Response, g, has_request_context, request, jsonify, send_file
 from Crypto.Cipher import AES
 import io
 from Crypto.Util.Padding import unpad
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+import cv2
 
 parser = argparse.ArgumentParser(description="使用ddddocr搭建的最简api服务")
 parser.add_argument("-p", "--port", type=int, default=9898)
 parser.add_argument("--ocr", action="store_true", help="开启ocr识别")
 parser.add_argument("--old", action="store_true", help="OCR是否启动旧模型")
 parser.add_argument("--det", action="store_true", help="开启目标检测")
-
-args = parser.parse_args()
+parser.add_argument("--async", dest="async_mode", action="store_true", help="使用gevent异步模式启动，出站请求不再阻塞其他接口")
+parser.add_argument("--cpu-threads", type=int, default=os.cpu_count() or 4, help="异步模式下执行识别、图片处理、解密的线程数")
+parser.add_argument("--load-mode", choices=["eager", "lazy", "preload"], default="eager",
+                    help="模型加载方式：eager启动时加载并在后台预热；lazy首次使用时加载；preload启动时加载并预热完成后才返回，"
+                         "配合gunicorn --preload在fork前加载，各worker以写时复制方式共享模型")
+parser.add_argument("--workers", type=int, default=0, help="推理进程数，每个进程持有独立的模型实例，0为在当前进程内推理")
+parser.add_argument("--models", default="", help="模型注册表配置文件(json)，可同时加载多个OCR/目标检测模型，"
+                                                 "请求通过model参数选择；不指定时按--ocr/--old/--det加载")
+parser.add_argument("--ort-intra-threads", type=int, default=0,
+                    help="onnxruntime单个算子内的线程数，0为默认值(开启--workers时为CPU核数/进程数)")
+parser.add_argument("--ort-inter-threads", type=int, default=0, help="onnxruntime算子间并行的线程数，0为默认值")
+parser.add_argument("--ort-graph-opt", choices=["disable", "basic", "extended", "all"], default="all",
+                    help="onnxruntime图优化级别")
+parser.add_argument("--ort-execution-mode", choices=["sequential", "parallel"], default="sequential",
+                    help="onnxruntime执行模式")
+parser.add_argument("--genshin-host", default="https://v2.genshinvoice.top", help="genshinvoice语音合成服务地址")
+parser.add_argument("--modelscope-host", default="https://www.modelscope.cn", help="AIAudio语音合成服务地址")
+parser.add_argument("--spool-dir", default=os.path.join(tempfile.gettempdir(), "ocr_api_spool"),
+                    help="rar2zip等任务的工作目录存放位置，可指定到tmpfs")
+parser.add_argument("--artifact-ttl", type=float, default=120, help="异常遗留的任务目录超过该时间(秒)后清理")
+parser.add_argument("--tts-cache-size", type=int, default=256, help="语音合成结果缓存条数，0为不缓存")
+parser.add_argument("--tts-cache-ttl", type=float, default=3600, help="语音合成结果缓存有效期(秒)")
+parser.add_argument("--tts-chunk-chars", type=int, default=200,
+                    help="超过该字数的文本按句切分后并发合成、按顺序流式返回，0为不切分")
+parser.add_argument("--tts-concurrency", type=int, default=4, help="长文本切分后同时合成的片段数")
+parser.add_argument("--zip-level", type=int, default=0, choices=range(10),
+                    help="rar2zip输出zip的压缩级别，0为仅存储，1-9为deflate压缩级别；图片音视频等已压缩的文件始终仅存储")
+parser.add_argument("--http-pool-size", type=int, default=32, help="出站请求每个host保持的长连接数")
+parser.add_argument("--http-connect-timeout", type=float, default=5, help="出站请求连接超时(秒)")
+parser.add_argument("--http-read-timeout", type=float, default=30, help="出站请求读取超时(秒)")
+parser.add_argument("--http-retries", type=int, default=2, help="出站请求连接失败或返回502/503/504时的重试次数")
+parser.add_argument("--http-max-size", type=int, default=50, help="读入内存的下载内容大小上限(MB)")
+parser.add_argument("--spool-max-size", type=int, default=2048, help="写入spool目录的下载文件大小上限(MB)")
+parser.add_argument("--jm-concurrency", type=int, default=8, help="/jm/chapter同时下载还原的图片数")
+parser.add_argument("--image-cache-dir", default=os.path.join(tempfile.gettempdir(), "ocr_api_images"),
+                    help="jm/51cg/aesDecryptImg处理后图片的磁盘缓存目录，多个进程可共用")
+parser.add_argument("--image-cache-size", type=int, default=512, help="图片磁盘缓存的容量上限(MB)，0为不缓存")
+parser.add_argument("--aes-concurrency", type=int, default=8, help="/aesDecryptImg/batch同时下载解密的图片数")
+parser.add_argument("--audio-cache-size", type=int, default=256,
+                    help="/genshininvoice与/AIAudio生成音频的缓存条数，0为不缓存")
+parser.add_argument("--audio-cache-ttl", type=float, default=3600, help="生成音频的缓存有效期(秒)")
+parser.add_argument("--ndjson-concurrency", type=int, default=8, help="NDJSON流式批量接口单个连接的并发处理数")
+parser.add_argument("--batch-window", type=float, default=0, help="微批处理收集窗口(毫秒)，0为不开启")
+parser.add_argument("--cache-size", type=int, default=0, help="识别结果内存缓存条数，0为不开启")
+parser.add_argument("--cache-ttl", type=float, default=600, help="识别结果缓存有效期(秒)")
+parser.add_argument("--cache-dir", default="", help="识别结果磁盘缓存目录，重启后仍然有效，默认不开启")
+parser.add_argument("--batch-size", type=int, default=16, help="微批处理单批最大图片数")
+parser.add_argument("--max-concurrency", type=int, default=0,
+                    help="ocr/det/slide每类操作同时处理的请求数，超出的请求排队等待，0为不限制")
+parser.add_argument("--max-queue", type=int, default=64, help="每类操作排队等待的请求数上限，队列满时返回429")
+parser.add_argument("--server-timing", action="store_true",
+                    help="以Server-Timing响应头返回请求内各阶段(read/decode/inference/encode/download/decrypt等)的耗时")
+parser.add_argument("--profile-token", default="", help="开启/debug/profile采样分析接口，请求需携带相同的令牌，默认不开启")
+parser.add_argument("--client-concurrency", type=int, default=0,
+                    help="单个客户端(请求头X-Client-Id，否则为来源IP)同时处理与排队的请求数上限，0为不限制")
+
+# 导入本模块时只使用默认参数，不读取命令行也不加载模型，由create_app按实际参数完成初始化
+args = parser.parse_args([])
 
 app = Flask(__name__)
 
+cpu_pool = None
+server = None
+result_cache = None
+artifact_store = None
+tts_engine = None
+http_client = None
+image_cache = None
+audio_proxy = None
+admission = None
+# 模型预热完成后置位，/ready据此返回是否可以接收流量
+ready = threading.Event()
+
+
+def run_cpu(func, *params):
+    # 异步模式下CPU密集或阻塞的操作放到有界的系统线程池执行，避免卡住事件循环
+    if cpu_pool is None:
+        return func(*params)
+    return cpu_pool.apply(func, params)
+
+
+class Metrics(object):
+    # 进程内指标：计数器与直方图，以Prometheus文本格式输出
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.inflight = 0
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * len(self.buckets) + [0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+    def render(self, gauges):
+        lines = []
+        with self.lock:
+            for name in sorted(set(key[0] for key in self.counters)):
+                lines.append(f'# TYPE {name} counter')
+                for (key_name, labels), value in sorted(self.counters.items()):
+                    if key_name == name:
+                        lines.append(f'{name}{self._labels(labels)} {value}')
+            for name in sorted(set(key[0] for key in self.histograms)):
+                lines.append(f'# TYPE {name} histogram')
+                for (key_name, labels), hist in sorted(self.histograms.items()):
+                    if key_name != name:
+                        continue
+                    for bound, count in zip(self.buckets, hist):
+                        lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {count}')
+                    lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {hist[-1]}')
+                    lines.append(f'{name}_sum{self._labels(labels)} {round(hist[-2], 6)}')
+                    lines.append(f'{name}_count{self._labels(labels)} {hist[-1]}')
+        for name, value in gauges:
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def route_label():
+    # 指标中的路由标签，opt为ocr/det/click时展开为具体路径
+    if not has_request_context():
+        return 'background'
+    if request.url_rule is None:
+        return 'unmatched'
+    rule = request.url_rule.rule
+    opt = (request.view_args or {}).get('opt')
+    if opt in ('ocr', 'det', 'click'):
+        rule = rule.replace('<opt>', opt)
+    return rule
+
+
+@contextmanager
+def stage(name):
+    # 记录请求内各阶段耗时：read/decode/inference/encode/download/decrypt/queue等
+    start = time.time()
+    try:
+        yield
+    finally:
+        cost = time.time() - start
+        metrics.observe('ocr_server_stage_seconds', [('route', route_label()), ('stage', name)], cost)
+        if has_request_context():
+            g.setdefault('stages', []).append((name, cost))
+
+
+@app.before_request
+def metrics_before_request():
+    g.start_time = time.time()
+    with metrics.lock:
+        metrics.inflight += 1
+
+
+@app.after_request
+def metrics_after_request(response):
+    route = route_label()
+    metrics.inc('ocr_server_requests_total', [('route', route), ('status', response.status_code)])
+    if response.status_code >= 400 or g.get('error'):
+        metrics.inc('ocr_server_errors_total', [('route', route)])
+    metrics.observe('ocr_server_request_seconds', [('route', route)], time.time() - g.start_time)
+    return response
+
+
+@app.teardown_request
+def metrics_teardown_request(exc):
+    with metrics.lock:
+        metrics.inflight -= 1
+
+
+@app.after_request
+def server_timing_header(response):
+    # 开启--server-timing时返回各阶段耗时(毫秒)，同名阶段累加；流式响应只包含开始发送前已完成的阶段
+    if args.server_timing:
+        costs = OrderedDict()
+        for name, cost in g.get('stages', []):
+            costs[name] = costs.get(name, 0) + cost
+        costs['total'] = time.time() - g.start_time
+        response.headers['Server-Timing'] = ', '.join(f'{name};dur={cost * 1000:.2f}' for name, cost in costs.items())
+    return response
+
+
+class SamplingProfiler(object):
+    # 采样分析器：按间隔抓取进程内各线程的调用栈，汇总为折叠栈格式(flamegraph.pl、speedscope可直接读取)
+    # 异步模式下在独立的系统线程中采样，主线程的栈即为当时正在运行的greenlet
+    IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py', 'socketserver.py', 'connection.py', 'socket.py',
+                  'ssl.py', 'hub.py', '_threading.py')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def profile(self, seconds, interval=0.01, idle=False):
+        if not self.lock.acquire(blocking=False):
+            raise Exception("已有正在进行的采样")
+        try:
+            if args.async_mode:
+                import gevent
+
+                return gevent.get_hub().threadpool.apply(self._sample, (seconds, interval, idle))
+            return self._sample(seconds, interval, idle)
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def _frame_name(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+    def _sample(self, seconds, interval, idle):
+        own = SamplingProfiler._sample.__code__
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        counts = {}
+        samples = 0
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                codes = []
+                while frame is not None and frame.f_code is not own:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                # 采样线程自身，以及阻塞在锁、队列、网络等待上的空闲线程不计入
+                if frame is not None or not codes:
+                    continue
+                if not idle and os.path.basename(codes[0].co_filename) in self.IDLE_FILES:
+                    continue
+                key = (names.get(ident, f'thread-{ident}'),) + tuple(reversed(codes))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            time.sleep(interval)
+        lines = []
+        for key, count in sorted(counts.items(), key=lambda item: -item[1]):
+            lines.append(';'.join([key[0]] + [self._frame_name(code) for code in key[1:]]) + f' {count}')
+        return samples, '\n'.join(lines) + '\n'
+
+
+profiler = SamplingProfiler()
+
+
+class Rejected(Exception):
+    # 被准入控制拒绝的请求：排队已满或超过客户端并发上限时为429，已过截止时间时为504
+    def __init__(self, message, status=429, retry_after=None):
+        super(Rejected, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def shed(op, reason, message, status=429, retry_after=None):
+    metrics.inc('ocr_server_shed_total', [('op', op), ('reason', reason)])
+    return Rejected(message, status, retry_after)
+
+
+@app.errorhandler(Rejected)
+def rejected_handler(e):
+    g.error = True
+    response = jsonify({"status": e.status, "result": "", "msg": str(e)})
+    response.status_code = e.status
+    if e.retry_after:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@app.before_request
+def parse_deadline():
+    # 请求头X-Request-Timeout为剩余的秒数，X-Request-Deadline为绝对的unix时间戳(秒)，格式错误时忽略
+    deadline = None
+    try:
+        if request.headers.get('X-Request-Timeout'):
+            deadline = g.start_time + float(request.headers['X-Request-Timeout'])
+        elif request.headers.get('X-Request-Deadline'):
+            deadline = float(request.headers['X-Request-Deadline'])
+    except ValueError:
+        pass
+    g.deadline = deadline
+
+
+def request_deadline():
+    return g.get('deadline') if has_request_context() else None
+
+
+def check_deadline(op, deadline=None):
+    # 已过截止时间的请求不再进入推理，客户端已经不会等待其结果
+    deadline = deadline or request_deadline()
+    if deadline is not None and time.time() >= deadline:
+        raise shed(op, 'deadline', "请求已超过截止时间", 504)
+
+
+class AdmissionControl(object):
+    # 准入控制：按操作类型限制同时处理的请求数，超出的请求在有界队列中等待，队列满时直接拒绝并给出Retry-After；
+    # 可限制单个客户端的并发数；排队超过请求截止时间的请求直接放弃。过载时吞吐维持在处理能力附近，而不是全部超时。
+    # batch接口按图片数占用并发额度(weight，最多占满全部额度)，避免一个请求带N张图绕过并发限制
+    def __init__(self, concurrency=0, queue_size=64, client_limit=0):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.client_limit = client_limit
+        self.lock = threading.Lock()
+        self.ops = {}
+        self.clients = {}
+
+    def _state(self, op):
+        state = self.ops.get(op)
+        if state is None:
+            state = self.ops[op] = {'active': 0, 'waiting': 0, 'cost': 0.1, 'cond': threading.Condition(self.lock)}
+        return state
+
+    def _retry_after(self, state):
+        # 按平均处理耗时估算排队的请求处理完所需的秒数
+        return max(1, int(state['cost'] * (state['waiting'] + 1) / max(1, self.concurrency)) + 1)
+
+    @contextmanager
+    def admit(self, op, client=None, deadline=None, weight=1):
+        check_deadline(op, deadline)
+        if self.concurrency:
+            weight = min(max(1, weight), self.concurrency)
+        with self.lock:
+            state = self._state(op)
+            if self.client_limit and self.clients.get(client, 0) >= self.client_limit:
+                raise shed(op, 'client', "超过客户端并发上限", retry_after=self._retry_after(state))
+            if (self.concurrency and state['active'] + weight > self.concurrency
+                    and state['waiting'] >= self.queue_size):
+                raise shed(op, 'queue', "服务繁忙，请稍后重试", retry_after=self._retry_after(state))
+            self.clients[client] = self.clients.get(client, 0) + 1
+            try:
+                state['waiting'] += 1
+                try:
+                    if self.concurrency and state['active'] + weight > self.concurrency:
+                        with stage('queue'):
+                            while state['active'] + weight > self.concurrency:
+                                timeout = None if deadline is None else deadline - time.time()
+                                if timeout is not None and timeout <= 0:
+                                    raise shed(op, 'deadline', "请求已超过截止时间", 504)
+                                state['cond'].wait(timeout)
+                finally:
+                    state['waiting'] -= 1
+                state['active'] += weight
+            except BaseException:
+                self._release_client(client)
+                raise
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                state['active'] -= weight
+                state['cost'] = state['cost'] * 0.8 + (time.time() - start) * 0.2
+                self._release_client(client)
+                # 等待方所需的额度不同，释放后全部唤醒由各自判断
+                state['cond'].notify_all()
+
+    def _release_client(self, client):
+        self.clients[client] -= 1
+        if not self.clients[client]:
+            del self.clients[client]
+
+    def stats(self):
+        with self.lock:
+            return {op: {'active': state['active'], 'waiting': state['waiting'], 'cost': round(state['cost'], 4)}
+                    for op, state in self.ops.items()}
+
+
+def request_client():
+    return request.headers.get('X-Client-Id') or request.remote_addr
+
+
+def admit_request(op, weight=1):
+    # 以当前请求的客户端与截止时间申请准入；只在需要推理时调用，命中结果缓存的请求不占用并发额度，
+    # batch接口按需要推理的图片数计权重
+    if admission is None:
+        return nullcontext()
+    return admission.admit(op, request_client(), request_deadline(), weight)
+
 
 # ddddocr
+GRAPH_OPT_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def model_config(args):
+    # 模型注册表：--models指定的json配置，或按--ocr/--old/--det生成；
+    # 会话参数的优先级为 模型的session > 配置文件的session > 命令行参数
+    session = {'graph_optimization_level': args.ort_graph_opt, 'execution_mode': args.ort_execution_mode}
+    intra_threads = args.ort_intra_threads
+    if not intra_threads and args.workers > 0:
+        # 多个推理进程各自使用全部核心会互相争抢，默认平分
+        intra_threads = max(1, (os.cpu_count() or 1) // args.workers)
+    if intra_threads:
+        session['intra_op_num_threads'] = intra_threads
+    if args.ort_inter_threads:
+        session['inter_op_num_threads'] = args.ort_inter_threads
+    if args.models:
+        with open(args.models, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    else:
+        models = {}
+        if args.ocr:
+            models['ocr'] = {'type': 'ocr', 'old': args.old}
+        if args.det:
+            models['det'] = {'type': 'det'}
+        config = {'models': models}
+    config['session'] = dict(session, **config.get('session', {}))
+    for name, spec in config['models'].items():
+        if spec.get('type', 'ocr') not in ('ocr', 'det'):
+            raise Exception(f"模型{name}的类型错误: {spec.get('type')}")
+    return config
+
+
+def session_options(config):
+    options = onnxruntime.SessionOptions()
+    if config.get('intra_op_num_threads'):
+        options.intra_op_num_threads = int(config['intra_op_num_threads'])
+    if config.get('inter_op_num_threads'):
+        options.inter_op_num_threads = int(config['inter_op_num_threads'])
+    options.graph_optimization_level = GRAPH_OPT_LEVELS[config.get('graph_optimization_level', 'all')]
+    if config.get('execution_mode') == 'parallel':
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    else:
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+
+def create_model(spec, session):
+    # spec: type为ocr或det；old/beta选择内置模型；onnx+charsets加载自定义模型，
+    # 只指定onnx时沿用内置模型的字符集与预处理，例如int8量化后的内置模型
+    kind = spec.get('type', 'ocr')
+    if spec.get('onnx') and spec.get('charsets'):
+        model = ddddocr.DdddOcr(import_onnx_path=spec['onnx'], charsets_path=spec['charsets'])
+    else:
+        model = ddddocr.DdddOcr(ocr=kind == 'ocr', det=kind == 'det', old=spec.get('old', False),
+                                beta=spec.get('beta', False))
+    # ddddocr以默认参数创建会话，这里按配置重新创建
+    graph_path = spec.get('onnx') or model._DdddOcr__graph_path
+    options = session_options(dict(session, **spec.get('session', {})))
+    model._DdddOcr__ort_session = onnxruntime.InferenceSession(graph_path, sess_options=options,
+                                                               providers=['CPUExecutionProvider'])
+    return model
+
+
+def registry_names(config):
+    # 注册表中各类型的模型名称与默认模型
+    ocr_names = [name for name, spec in config['models'].items() if spec.get('type', 'ocr') == 'ocr']
+    det_names = [name for name, spec in config['models'].items() if spec.get('type', 'ocr') == 'det']
+    return {"ocr": ocr_names, "det": det_names,
+            "default_ocr": config.get('default_ocr') or (ocr_names[0] if ocr_names else None),
+            "default_det": config.get('default_det') or (det_names[0] if det_names else None)}
+
+
+def registry_key(config, name, kind='ocr'):
+    # 缓存键使用的模型标识：实际使用的模型名称(未指定时为默认模型)加上该模型配置的摘要，
+    # 注册表或--old变化后磁盘缓存不会混用不同模型的结果
+    name = name or registry_names(config)['default_' + kind]
+    spec = json.dumps(config['models'].get(name), sort_keys=True)
+    return f"{name}:{hashlib.blake2b(spec.encode(), digest_size=4).hexdigest()}"
+
+
 class Server(object):
-    def __init__(self, ocr=True, det=False, old=False):
-        self.ocr_option = ocr
-        self.det_option = det
-        self.old_option = old
-        self.ocr = None
-        self.det = None
-        if self.ocr_option:
-            print("ocr模块开启")
-            if self.old_option:
-                print("使用OCR旧模型启动")
-                self.ocr = ddddocr.DdddOcr(old=True)
-            else:
-                print("使用OCR新模型启动，如需要使用旧模型，请额外添加参数  --old开启")
-                self.ocr = ddddocr.DdddOcr()
+    def __init__(self, config, lazy=False):
+        self.config = config
+        self.models = {}
+        names = registry_names(config)
+        self.ocr_names = names['ocr']
+        self.det_names = names['det']
+        self.ocr_option = bool(self.ocr_names)
+        self.det_option = bool(self.det_names)
+        self.default_ocr = names['default_ocr']
+        self.default_det = names['default_det']
+        self.batch_axes = {}
+        self.loaded = False
+        self.load_lock = threading.Lock()
+        if lazy:
+            print("模型将在首次使用时加载")
         else:
+            self.load()
+
+    def load(self):
+        if self.loaded:
+            return
+        with self.load_lock:
+            if not self.loaded:
+                self._load()
+                self.loaded = True
+
+    def _load(self):
+        if not self.ocr_option:
             print("ocr模块未开启，如需要使用，请使用参数  --ocr开启")
-        if self.det_option:
-            print("目标检测模块开启")
-            self.det = ddddocr.DdddOcr(det=True)
-        else:
+        if not self.det_option:
             print("目标检测模块未开启，如需要使用，请使用参数  --det开启")
+        for name, spec in self.config['models'].items():
+            print(f"加载{'OCR' if spec.get('type', 'ocr') == 'ocr' else '目标检测'}模型{name}: {spec}")
+            self.models[name] = create_model(spec, self.config['session'])
 
-    def classification(self, img: bytes):
-        if self.ocr_option:
-            return self.ocr.classification(img)
-        else:
+    def model(self, name, kind='ocr'):
+        # 按名称取模型，未指定时使用该类型的默认模型
+        if kind == 'ocr' and not self.ocr_option:
             raise Exception("ocr模块未开启")
-
-    def detection(self, img: bytes):
-        if self.det_option:
-            return self.det.detection(img)
-        else:
+        if kind == 'det' and not self.det_option:
             raise Exception("目标检测模块模块未开启")
-
-    def slide(self, target_img: bytes, bg_img: bytes, algo_type: str):
-        dddd = self.ocr or self.det or ddddocr.DdddOcr(ocr=False)
+        name = name or (self.default_ocr if kind == 'ocr' else self.default_det)
+        if name not in (self.ocr_names if kind == 'ocr' else self.det_names):
+            raise Exception(f"模型不存在: {name}")
+        self.load()
+        return self.models[name]
+
+    def model_names(self):
+        return {"ocr": self.ocr_names, "det": self.det_names, "default_ocr": self.default_ocr,
+                "default_det": self.default_det}
+
+    def model_key(self, name, kind='ocr'):
+        return registry_key(self.config, name, kind)
+
+    def warmup(self):
+        # 用合成图片把各模型完整跑一遍，完成onnxruntime首次推理时的初始化与内存分配
+        self.load()
+        imgs = warmup_images()
+        for name in self.ocr_names:
+            self.classification(imgs['image'], name)
+        for name in self.det_names:
+            self.detection(imgs['image'], name)
+        self.slide(imgs['target_img'], imgs['bg_img'], 'match')
+        self.slide(imgs['bg_img'], imgs['bg_img'], 'compare')
+
+    def classification(self, img: bytes, model=None):
+        return run_cpu(self._classify, self.model(model), img, model)
+
+    def classification_batch(self, imgs, model=None):
+        # 批量识别，返回与imgs一一对应的结果，单张失败时对应位置为异常对象
+        return run_cpu(self._classification_batch, imgs, self.model(model), model)
+
+    def _classification_batch(self, imgs, ocr, model=None):
+        if len(imgs) == 1 or not self.batch_supported(model):
+            return [self._try(self._classify, ocr, img, model) for img in imgs]
+        results = [None] * len(imgs)
+        arrays = {}
+        for i, img in enumerate(imgs):
+            try:
+                arrays[i] = self._ocr_preprocess(img)
+            except Exception as e:
+                results[i] = e
+        for i, text in self._ocr_infer(arrays, ocr, self.batch_axes[model]).items():
+            results[i] = text
+        return results
+
+    @staticmethod
+    def _try(func, *args):
+        try:
+            return func(*args)
+        except Exception as e:
+            return e
+
+    def batch_supported(self, model=None):
+        # 探测OCR模型的batch维度是否可变，以及输出中batch所在的轴，每个模型只探测一次
+        ocr = self.model(model)
+        if model not in self.batch_axes:
+            axis = None
+            session = getattr(ocr, '_DdddOcr__ort_session', None)
+            if session is not None and getattr(ocr, '_DdddOcr__charset', None) \
+                    and not getattr(ocr, 'use_import_onnx', False):
+                try:
+                    probe = np.zeros((2, 1, 64, 256), dtype=np.float32)
+                    out = session.run(None, {session.get_inputs()[0].name: probe})[0]
+                    if out.ndim in (2, 3) and 2 in out.shape[:2]:
+                        axis = out.shape[:2].index(2)
+                except Exception as e:
+                    print(f"OCR模型{model or self.default_ocr}不支持批量推理: {str(e).splitlines()[0]}")
+            self.batch_axes[model] = axis
+        return self.batch_axes[model] is not None
+
+    def _classify(self, ocr, img, model=None):
+        # 图片字节交给ddddocr；像素数组跳过解码，直接预处理后推理
+        if not isinstance(img, np.ndarray):
+            return ocr.classification(img)
+        if getattr(ocr, 'use_import_onnx', False):
+            # 自定义模型的缩放和通道由其配置决定，交给ddddocr处理
+            if img.dtype != np.uint8:
+                raise Exception("自定义模型不支持已归一化的灰度数组")
+            return ocr.classification(Image.fromarray(pixels_to_rgb(img)))
+        return self._ocr_infer({0: self._ocr_preprocess(img)}, ocr, self.batch_axes.get(model) or 0)[0]
+
+    @staticmethod
+    def _ocr_preprocess(img):
+        # 与ddddocr一致的预处理：等比缩放到高64，灰度化并归一化到[-1, 1]
+        if isinstance(img, np.ndarray):
+            return ocr_pixels_preprocess(img)
+        image = Image.open(io.BytesIO(img))
+        image = image.resize((int(image.size[0] * (64 / image.size[1])), 64), Image.LANCZOS).convert('L')
+        return (np.asarray(image, dtype=np.float32) / 255. - 0.5) / 0.5
+
+    def _ocr_infer(self, arrays: dict, ocr, batch_axis):
+        # 按宽度排序后分组，组内以边缘像素补齐到相同宽度，堆叠为一次推理
+        session = ocr._DdddOcr__ort_session
+        input_name = session.get_inputs()[0].name
+        order = sorted(arrays, key=lambda i: arrays[i].shape[1])
+        groups = []
+        for i in order:
+            if groups and arrays[i].shape[1] <= arrays[groups[-1][0]].shape[1] * 1.25:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+        texts = {}
+        for group in groups:
+            width = max(arrays[i].shape[1] for i in group)
+            batch = np.stack([np.pad(arrays[i], ((0, 0), (0, width - arrays[i].shape[1])), mode='edge')
+                              for i in group])[:, np.newaxis]
+            out = session.run(None, {input_name: batch})[0]
+            for n, i in enumerate(group):
+                texts[i] = self._ctc_decode(out[:, n] if batch_axis == 1 else out[n], ocr._DdddOcr__charset)
+        return texts
+
+    @staticmethod
+    def _ctc_decode(seq, charset):
+        # 模型输出可能是logits，也可能已经是argmax后的下标序列
+        if seq.ndim > 1:
+            seq = np.argmax(seq, axis=-1)
+        result = []
+        last_item = 0
+        for item in seq:
+            if item == last_item:
+                continue
+            last_item = item
+            if item != 0:
+                result.append(charset[item])
+        return ''.join(result)
+
+    def detection(self, img: bytes, model=None):
+        det = self.model(model, 'det')
+        if isinstance(img, np.ndarray):
+            return run_cpu(self._detect_pixels, det, img)
+        return run_cpu(det.detection, img)
+
+    def click(self, img, det_model=None, ocr_model=None):
+        return run_cpu(self._click, img, self.model(det_model, 'det'), self.model(ocr_model), ocr_model)
+
+    def _click(self, img, det, ocr, ocr_model=None):
+        # 点选验证码：图片只解码一次，检测出的文字框直接在解码后的数组上裁剪，所有裁剪一起批量识别
+        if isinstance(img, np.ndarray):
+            image = pixels_to_bgr(img)
+        else:
+            image = SlideEngine._decode(img, cv2.IMREAD_COLOR)
+        boxes = [box for box in self._detect_pixels(det, image) if box[2] > box[0] and box[3] > box[1]]
+        crops = [image[y0:y1, x0:x1] for x0, y0, x1, y1 in boxes]
+        texts = self._classification_batch(crops, ocr, ocr_model) if crops else []
+        return [{"box": box, "text": "" if isinstance(text, Exception) else text} for box, text in zip(boxes, texts)]
+
+    @staticmethod
+    def _detect_pixels(det, img):
+        # 与ddddocr的get_bbox一致，省去图片解码，坐标换算与边界裁剪向量化
+        image = pixels_to_bgr(img)
+        im, ratio = det.preproc(image, (416, 416))
+        session = det._DdddOcr__ort_session
+        output = session.run(None, {session.get_inputs()[0].name: im[None, :, :, :]})
+        predictions = det.demo_postprocess(output[0], (416, 416))[0]
+        boxes, scores = predictions[:, :4], predictions[:, 4:5] * predictions[:, 5:]
+        boxes_xyxy = np.concatenate([boxes[:, :2] - boxes[:, 2:] / 2., boxes[:, :2] + boxes[:, 2:] / 2.], axis=1)
+        pred = det.multiclass_nms(boxes_xyxy / ratio, scores, nms_thr=0.45, score_thr=0.1)
+        if pred is None:
+            return []
+        height, width = image.shape[:2]
+        boxes = np.clip(pred[:, :4], [0, 0, -np.inf, -np.inf], [np.inf, np.inf, width, height])
+        return boxes.astype(int).tolist()
+
+    def slide(self, target_img: bytes, bg_img: bytes, algo_type: str, options=None):
+        return run_cpu(slide_engine.slide, target_img, bg_img, algo_type, options)
+
+    def slide_batch(self, pairs, algo_type: str, options=None):
+        return run_cpu(slide_engine.slide_batch, pairs, algo_type, options)
+
+
+PIXEL_TYPES = ('npy', 'raw')
+PIXEL_MODES = {'L': 1, 'RGB': 3, 'BGR': 3, 'RGBA': 4, 'BGRA': 4}
+
+
+def load_pixels(data: bytes, img_type, params, img_name='image'):
+    # 解析已解码的像素数据，统一为opencv的通道顺序：灰度(H,W)、BGR(H,W,3)、BGRA(H,W,4)的uint8数组，
+    # 或高度任意、已归一化到[-1, 1]的灰度float32数组(只能用于OCR)
+    # npy: numpy数组文件；raw: 按width、height、mode解释的原始像素，多张图片时可用{img_name}_width等参数分别指定
+    # mode: L/RGB/RGBA/BGR/BGRA，npy的彩色数组默认为RGB/RGBA
+    def param(key):
+        return params.get(f'{img_name}_{key}') or params.get(key)
+
+    mode = (param('mode') or '').upper()
+    if mode and mode not in PIXEL_MODES:
+        raise Exception(f"不支持的像素格式: {mode}")
+    try:
+        if img_type == 'npy':
+            pixels = np.load(io.BytesIO(data), allow_pickle=False)
+        else:
+            mode = mode or 'L'
+            pixels = np.frombuffer(data, dtype=np.uint8).reshape(int(param('height')), int(param('width')),
+                                                                 PIXEL_MODES[mode])
+    except Exception as e:
+        raise Exception(f"像素数据解析失败: {e}")
+    if pixels.ndim == 3 and pixels.shape[2] == 1:
+        pixels = pixels[:, :, 0]
+    if pixels.ndim not in (2, 3) or pixels.size == 0 or (pixels.ndim == 3 and pixels.shape[2] not in (3, 4)):
+        raise Exception(f"不支持的像素数组形状: {pixels.shape}")
+    if np.issubdtype(pixels.dtype, np.floating):
+        if pixels.ndim != 2:
+            raise Exception("已归一化的数组只支持灰度图")
+        return np.ascontiguousarray(pixels, dtype=np.float32)
+    if pixels.dtype != np.uint8:
+        raise Exception(f"不支持的像素类型: {pixels.dtype}")
+    if pixels.ndim == 3 and not mode.startswith('BGR'):
+        pixels = cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR if pixels.shape[2] == 3 else cv2.COLOR_RGBA2BGRA)
+    return np.ascontiguousarray(pixels)
+
+
+def pixels_to_bgr(pixels):
+    if pixels.dtype != np.uint8:
+        raise Exception("已归一化的灰度数组只能用于OCR")
+    if pixels.ndim == 2:
+        return cv2.cvtColor(pixels, cv2.COLOR_GRAY2BGR)
+    return pixels if pixels.shape[2] == 3 else np.ascontiguousarray(pixels[:, :, :3])
+
+
+def pixels_to_rgb(pixels):
+    return pixels if pixels.ndim == 2 else cv2.cvtColor(pixels_to_bgr(pixels), cv2.COLOR_BGR2RGB)
+
+
+@lru_cache(maxsize=256)
+def lanczos_weights(size_in, size_out):
+    # 与PIL的LANCZOS缩放相同的一维权重矩阵(size_out, size_in)，缩小时按比例放宽支撑范围以抗锯齿
+    scale = size_in / size_out
+    filter_scale = max(scale, 1.0)
+    support = 3.0 * filter_scale
+    centers = (np.arange(size_out) + 0.5) * scale
+    lo = np.maximum((centers - support + 0.5).astype(int), 0)
+    hi = np.minimum((centers + support + 0.5).astype(int), size_in)
+    x = np.arange(size_in)
+    d = (x[None, :] - centers[:, None] + 0.5) / filter_scale
+    weights = np.where(np.abs(d) < 3, np.sinc(d) * np.sinc(d / 3), 0.)
+    weights[(x[None, :] < lo[:, None]) | (x[None, :] >= hi[:, None])] = 0
+    return (weights / weights.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def resize_lanczos(planes, width, height, quantize=True):
+    # planes为(..., H, W)的float32数组，先水平后垂直两次矩阵乘完成缩放，quantize时与PIL一样在每次之后取整到[0, 255]
+    if planes.shape[-1] != width:
+        planes = planes @ lanczos_weights(planes.shape[-1], width).T
+        if quantize:
+            planes = np.clip(np.round(planes, out=planes), 0, 255, out=planes)
+    if planes.shape[-2] != height:
+        planes = lanczos_weights(planes.shape[-2], height) @ planes
+        if quantize:
+            planes = np.clip(np.round(planes, out=planes), 0, 255, out=planes)
+    return planes
+
+
+def ocr_pixels_preprocess(pixels):
+    # 像素数组的OCR预处理，结果与ddddocr对解码后图片的处理一致：
+    # 彩色图按PIL的方式缩放(带透明通道时预乘alpha)后再以PIL的系数灰度化；
+    # 归一化的浮点运算顺序也保持一致，个别处于边界的字符对最后一位的误差也很敏感
+    height, width = pixels.shape[:2]
+    size = (max(1, int(width * (64 / height))), 64)
+    if pixels.dtype != np.uint8:
+        return resize_lanczos(pixels, *size, quantize=False)
+    if pixels.ndim == 2:
+        gray = resize_lanczos(pixels.astype(np.float32), *size)
+    else:
+        # 转为按通道排列(C, H, W)，每个通道都是连续的矩阵
+        planes = np.ascontiguousarray(pixels.transpose(2, 0, 1), dtype=np.float32)
+        if planes.shape[0] == 4:
+            alpha = planes[3]
+            planes[:3] = np.round(planes[:3] * alpha / 255.)
+            planes = resize_lanczos(planes, *size)
+            alpha = planes[3]
+            planes = np.clip(np.round(planes[:3] * 255. / np.maximum(alpha, 1)), 0, 255) * (alpha > 0)
+        else:
+            planes = resize_lanczos(planes, *size)
+        bgr = planes.astype(np.uint32)
+        gray = (bgr[2] * 19595 + bgr[1] * 38470 + bgr[0] * 7471 + 0x8000) >> 16
+    return (gray.astype(np.float32) / 255. - 0.5) / 0.5
+
+
+def warmup_images():
+    # 预热用的合成图片：文字图片，以及带透明通道的滑块和对应的背景
+    image = Image.new('RGB', (120, 40), 'white')
+    ImageDraw.Draw(image).text((10, 12), 'ab12', fill='black')
+    bg = Image.new('RGB', (240, 80), (120, 160, 200))
+    ImageDraw.Draw(bg).rectangle((150, 20, 190, 60), fill=(60, 60, 60))
+    target = Image.new('RGBA', (50, 80), (0, 0, 0, 0))
+    ImageDraw.Draw(target).rectangle((5, 20, 45, 60), fill=(200, 100, 50, 255))
+    imgs = {}
+    for name, img in (('image', image), ('bg_img', bg), ('target_img', target)):
+        buf = io.BytesIO()
+        img.save(buf, format='PNG')
+        imgs[name] = buf.getvalue()
+    return imgs
+
+
+class SlideEngine(object):
+    # 滑块识别引擎，进程内只创建一次；灰度、边缘、差分计算均为numpy/opencv向量化实现
+    # options: scales 多尺度匹配的缩放比例列表；roi 背景中的搜索区域(x0, y0, x1, y1)，'auto'为滑块所在的水平带
+    def slide(self, target_img: bytes, bg_img: bytes, algo_type: str, options=None):
+        options = options or {}
         if algo_type == 'match':
-            return dddd.slide_match(target_img, bg_img)
+            return self.match(target_img, bg_img, options.get('scales'), options.get('roi'))
         elif algo_type == 'compare':
-            return dddd.slide_comparison(target_img, bg_img)
+            return self.compare(target_img, bg_img)
         else:
             raise Exception(f"不支持的滑块算法类型: {algo_type}")
 
+    def slide_batch(self, pairs, algo_type: str, options=None):
+        results = []
+        for target_img, bg_img in pairs:
+            try:
+                results.append(self.slide(target_img, bg_img, algo_type, options))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    @staticmethod
+    def _decode(img: bytes, flags=cv2.IMREAD_UNCHANGED):
+        if isinstance(img, np.ndarray):
+            return pixels_to_bgr(img) if flags == cv2.IMREAD_COLOR else img
+        image = cv2.imdecode(np.frombuffer(img, np.uint8), flags)
+        if image is None:
+            raise Exception("图片解码失败")
+        return image
+
+    def _target(self, target_img: bytes):
+        # 有透明通道时按不透明区域裁剪出滑块，返回滑块及其在原图中的位置
+        image = self._decode(target_img)
+        if image.ndim == 3 and image.shape[2] == 4:
+            ys, xs = np.nonzero(image[:, :, 3])
+            if len(xs):
+                x0, y0 = int(xs.min()), int(ys.min())
+                return np.ascontiguousarray(image[y0:ys.max() + 1, x0:xs.max() + 1, :3]), x0, y0
+            image = np.ascontiguousarray(image[:, :, :3])
+        return image, 0, 0
+
+    def match(self, target_img: bytes, bg_img: bytes, scales=None, roi=None):
+        target, target_x, target_y = self._target(target_img)
+        background = self._decode(bg_img, cv2.IMREAD_COLOR)
+        x0, y0, x1, y1 = 0, 0, background.shape[1], background.shape[0]
+        if roi == 'auto':
+            y0, y1 = max(0, target_y - 10), min(y1, target_y + target.shape[0] + 10)
+        elif roi:
+            x0, y0, x1, y1 = max(0, roi[0]), max(0, roi[1]), min(x1, roi[2]), min(y1, roi[3])
+        bg_edge = cv2.Canny(background[y0:y1, x0:x1], 100, 200)
+        best = None
+        for scale in scales or [1.0]:
+            scaled = target if scale == 1 else cv2.resize(target, None, fx=scale, fy=scale)
+            h, w = scaled.shape[:2]
+            if h > bg_edge.shape[0] or w > bg_edge.shape[1] or min(h, w) < 2:
+                continue
+            res = cv2.matchTemplate(bg_edge, cv2.Canny(scaled, 100, 200), cv2.TM_CCOEFF_NORMED)
+            _, max_val, _, max_loc = cv2.minMaxLoc(res)
+            if best is None or max_val > best[0]:
+                best = (max_val, max_loc, w, h)
+        if best is None:
+            raise Exception("滑块图片大于背景图片的搜索区域")
+        max_val, max_loc, w, h = best
+        x, y = max_loc[0] + x0, max_loc[1] + y0
+        return {"target_y": target_y, "target": [int(x), int(y), int(x + w), int(y + h)],
+                "confidence": round(float(max_val), 4)}
+
+    def compare(self, target_img: bytes, bg_img: bytes):
+        # 差分超过阈值的像素按列计数，第一个计数不少于5的列即为缺口位置
+        target = self._decode(target_img, cv2.IMREAD_COLOR)
+        background = self._decode(bg_img, cv2.IMREAD_COLOR)
+        mask = (cv2.absdiff(background, target) > 80).any(axis=2)
+        counts = mask.sum(axis=0)
+        cols = np.nonzero(counts >= 5)[0]
+        if not len(cols):
+            return {"target": [0, 0], "confidence": 0.0}
+        start = end = int(cols[0])
+        while end < len(counts) and counts[end] >= 5:
+            end += 1
+        rows = np.nonzero(mask[:, start])[0]
+        # 置信度为差异像素集中在缺口列中的比例
+        confidence = mask[:, start:end].sum() / mask.sum()
+        return {"target": [start + 2, int(rows[4]) - 5], "confidence": round(float(confidence), 4)}
+
+
+slide_engine = SlideEngine()
+
+
+class MicroBatcher(object):
+    # 跨请求微批处理：在窗口期内收集并发的OCR请求，合并为一次批量推理后分发结果
+    def __init__(self, server, window=0.003, max_size=16, parallel=1):
+        self.server = server
+        self.window = window
+        self.max_size = max_size
+        self.parallel = parallel
+        self.supported = {}
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def _start(self):
+        # 收集线程在首次使用时按进程启动，preload模式下fork出的子进程也能正常工作
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                self.executor = ThreadPoolExecutor(max_workers=self.parallel)
+                threading.Thread(target=self._loop, daemon=True).start()
+                self.pid = os.getpid()
+
+    def classification(self, img: bytes, model=None):
+        if not self.batching(model):
+            return self.server.classification(img, model)
+        return self._submit('ocr', img, model)
+
+    def batching(self, model=None):
+        # 是否支持批量推理按模型在首次使用时探测(此时模型已经加载)，不支持的模型逐张推理、不经过收集窗口
+        supported = self.supported.get(model)
+        if supported is None:
+            supported = self.supported[model] = self.server.batch_supported(model)
+            print(f"OCR模型{model or self.server.model_names()['default_ocr']}"
+                  f"{'开启' if supported else '不支持批量推理，未开启'}微批处理")
+        return supported
+
+    def detection(self, img: bytes, model=None):
+        return self.server.detection(img, model)
+
+    def classification_batch(self, imgs, model=None):
+        return self.server.classification_batch(imgs, model)
+
+    def click(self, img, det_model=None, ocr_model=None):
+        return self.server.click(img, det_model, ocr_model)
+
+    def model_names(self):
+        return self.server.model_names()
+
+    def model_key(self, name, kind='ocr'):
+        return self.server.model_key(name, kind)
+
+    def slide(self, target_img: bytes, bg_img: bytes, algo_type: str, options=None):
+        return self.server.slide(target_img, bg_img, algo_type, options)
+
+    def slide_batch(self, pairs, algo_type: str, options=None):
+        return self.server.slide_batch(pairs, algo_type, options)
+
+    def warmup(self):
+        return self.server.warmup()
+
+    def _submit(self, op, img, model=None):
+        if self.pid != os.getpid():
+            self._start()
+        item = {'op': op, 'img': img, 'model': model, 'deadline': request_deadline(), 'event': threading.Event(),
+                'result': None}
+        self.queue.put(item)
+        item['event'].wait()
+        if isinstance(item['result'], Exception):
+            raise item['result']
+        return item['result']
+
+    def _loop(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.time() + self.window
+            while len(items) < self.max_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # 在窗口期内过了截止时间的请求不再参与推理；不同模型的请求分别合并推理
+            groups = OrderedDict()
+            for item in items:
+                if item['deadline'] is not None and time.time() >= item['deadline']:
+                    item['result'] = shed(item['op'], 'deadline', "请求已超过截止时间", 504)
+                    item['event'].set()
+                    continue
+                groups.setdefault(item['model'], []).append(item)
+            for model, group in groups.items():
+                self.executor.submit(self._run, group, model)
+
+    def _run(self, items, model=None):
+        try:
+            results = self.server.classification_batch([item['img'] for item in items], model)
+        except Exception as e:
+            results = [e] * len(items)
+        for item, result in zip(items, results):
+            item['result'] = result
+            item['event'].set()
+
+
+def _worker_main(conn, config, lazy):
+    # 推理进程入口：加载独立的模型实例，循环处理主进程发来的任务
+    global cpu_pool
+    # 异步模式下fork出的推理进程不使用父进程的gevent线程池，推理直接在本进程执行
+    cpu_pool = None
+    worker = Server(config, lazy=lazy)
+    while True:
+        try:
+            job_id, method, params = conn.recv()
+        except EOFError:
+            break
+        try:
+            result = getattr(worker, method)(*params)
+        except Exception as e:
+            # onnxruntime等异常不一定能pickle，统一转为普通异常
+            result = Exception(str(e))
+        conn.send((job_id, result))
+
+
+class WorkerPool(object):
+    # 多进程推理池：每个进程持有独立的模型实例，请求通过管道分发给当前负载最低的进程
+    # 各方法对应的操作类型，截止时间的指标标签与进程内推理、准入控制保持一致
+    OPS = {'classification': 'ocr', 'classification_batch': 'ocr', 'detection': 'det', 'click': 'click',
+           'slide': 'slide', 'slide_batch': 'slide'}
+
+    def __init__(self, workers, config, lazy=False):
+        self.config = config
+        self.lock = threading.Lock()
+        self.job_id = 0
+        self.pending = {}
+        self.workers = []
+        for _ in range(workers):
+            conn, child_conn = multiprocessing.Pipe()
+            # 异步模式下socketpair已被gevent替换为非阻塞，Connection的读写需要阻塞的文件描述符
+            os.set_blocking(conn.fileno(), True)
+            os.set_blocking(child_conn.fileno(), True)
+            process = multiprocessing.Process(target=_worker_main, args=(child_conn, config, lazy), daemon=True)
+            process.start()
+            worker = {'conn': conn, 'process': process, 'jobs': set(), 'send_lock': threading.Lock()}
+            self.workers.append(worker)
+            threading.Thread(target=self._reader, args=(worker,), daemon=True).start()
+        print(f"推理进程池开启，共{workers}个进程")
+
+    def classification(self, img: bytes, model=None):
+        return self._call('classification', img, model)
+
+    def detection(self, img: bytes, model=None):
+        return self._call('detection', img, model)
+
+    def classification_batch(self, imgs, model=None):
+        return self._call('classification_batch', imgs, model)
+
+    def click(self, img, det_model=None, ocr_model=None):
+        return self._call('click', img, det_model, ocr_model)
+
+    def batch_supported(self, model=None):
+        return self._call('batch_supported', model)
+
+    def model_names(self):
+        # 模型名称由配置决定，不必询问推理进程
+        return registry_names(self.config)
+
+    def model_key(self, name, kind='ocr'):
+        return registry_key(self.config, name, kind)
+
+    def slide(self, target_img: bytes, bg_img: bytes, algo_type: str, options=None):
+        return self._call('slide', target_img, bg_img, algo_type, options)
+
+    def slide_batch(self, pairs, algo_type: str, options=None):
+        return self._call('slide_batch', pairs, algo_type, options)
+
+    def warmup(self):
+        # 每个推理进程都要预热，不能按负载分发
+        for worker in list(self.workers):
+            self._call('warmup', worker=worker)
+
+    def _call(self, method, *params, worker=None):
+        if worker is None:
+            check_deadline(self.OPS.get(method, method))
+        job = {'event': threading.Event(), 'result': None}
+        with self.lock:
+            if worker is None:
+                worker = min(self.workers, key=lambda w: len(w['jobs']))
+            self.job_id += 1
+            job_id = self.job_id
+            self.pending[job_id] = job
+            worker['jobs'].add(job_id)
+        with worker['send_lock']:
+            run_cpu(worker['conn'].send, (job_id, method, params))
+        job['event'].wait()
+        if isinstance(job['result'], Exception):
+            raise job['result']
+        return job['result']
+
+    def _finish(self, worker, job_id, result):
+        with self.lock:
+            worker['jobs'].discard(job_id)
+            job = self.pending.pop(job_id, None)
+        if job is not None:
+            job['result'] = result
+            job['event'].set()
+
+    def _reader(self, worker):
+        while True:
+            try:
+                if cpu_pool is not None:
+                    # 异步模式下先等待管道可读，避免recv阻塞事件循环
+                    from gevent.socket import wait_read
+
+                    wait_read(worker['conn'].fileno())
+                job_id, result = worker['conn'].recv()
+            except EOFError:
+                break
+            self._finish(worker, job_id, result)
+        # 进程异常退出时，让等待中的请求立即失败，并不再向其分发任务
+        with self.lock:
+            if worker in self.workers and len(self.workers) > 1:
+                self.workers.remove(worker)
+        for job_id in list(worker['jobs']):
+            self._finish(worker, job_id, Exception("推理进程异常退出"))
+
+
+def build_server(args):
+    lazy = args.load_mode == 'lazy'
+    config = model_config(args)
+    if args.workers > 0:
+        # 进程池模式下主进程不加载模型
+        server = WorkerPool(args.workers, config, lazy=lazy)
+    else:
+        server = Server(config, lazy=lazy)
+    if args.batch_window > 0:
+        # 官方模型的batch维度固定为1，只有支持批量推理的模型才开启微批处理；
+        # lazy模式下不为探测而提前加载模型，改为各模型首次识别时探测
+        has_ocr = any(spec.get('type', 'ocr') == 'ocr' for spec in config['models'].values())
+        if not has_ocr:
+            print("未开启OCR模型，微批处理未开启")
+        elif lazy:
+            print(f"微批处理窗口{args.batch_window}毫秒，单批最多{args.batch_size}张，"
+                  f"是否支持批量推理在模型首次使用时探测")
+            server = MicroBatcher(server, args.batch_window / 1000, args.batch_size, max(1, args.workers))
+        elif server.batch_supported():
+            print(f"微批处理开启，窗口{args.batch_window}毫秒，单批最多{args.batch_size}张")
+            server = MicroBatcher(server, args.batch_window / 1000, args.batch_size, max(1, args.workers))
+        else:
+            print("当前OCR模型不支持批量推理(自带模型的输入batch维度固定为1)，微批处理未开启")
+    return server
+
+
+class LRUCache(object):
+    # 线程安全的LRU缓存，限制条目数与有效期(ttl为0时不过期)
+    def __init__(self, max_size=1024, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and self.ttl and time.time() - item[1] > self.ttl:
+                del self.data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.time())
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size": len(self.data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 4) if total else 0}
+
+
+class ResultCache(LRUCache):
+    # 识别结果缓存：内存LRU之下可选一层磁盘缓存，以json文件保存，重启后仍然有效
+    def __init__(self, max_size=1024, ttl=0, cache_dir=''):
+        super(ResultCache, self).__init__(max_size, ttl)
+        self.cache_dir = cache_dir
+        self.disk_hits = 0
+        self.disk_writes = 0
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, key):
+        value = super(ResultCache, self).get(key)
+        if value is not None or not self.cache_dir:
+            return value
+        path = os.path.join(self.cache_dir, key + '.json')
+        try:
+            if self.ttl and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        super(ResultCache, self).set(key, value)
+        return value
+
+    def set(self, key, value):
+        super(ResultCache, self).set(key, value)
+        if not self.cache_dir:
+            return
+        path = os.path.join(self.cache_dir, key + '.json')
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.disk_writes += 1
+            prune = self.ttl and self.disk_writes % 1000 == 0
+        if prune:
+            self.prune_disk()
+
+    def prune_disk(self):
+        # 每写入1000次清理一次磁盘上过期的缓存文件
+        now = time.time()
+        for file in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        ret = super(ResultCache, self).stats()
+        ret.update({"disk_dir": self.cache_dir, "disk_hits": self.disk_hits})
+        return ret
+
+
+class ArtifactStore(object):
+    # 接口产物存储：任务的工作目录建在独立的spool目录中，使用中的目录记录在进程内的集合里，任务结束后立即删除；
+    # 后台清理线程定期刷新使用中目录的修改时间，并删除超过保留时间的目录，请求或进程异常退出后遗留的目录也会被清理。
+    # 多个进程共用spool目录时，其他进程使用中的目录由其清理线程刷新修改时间，不会被误删
+    PREFIX = 'job-'
+
+    def __init__(self, spool_dir, ttl=120):
+        self.spool_dir = spool_dir
+        self.ttl = ttl
+        self.interval = min(10, max(1, ttl / 4))
+        self.busy = set()
+        self.lock = threading.Lock()
+        self.pid = None
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        # 启动时清理之前的进程遗留的目录
+        self.purge(ttl)
+
+    def new_dir(self):
+        # 单次任务独立的工作目录，使用中不会被清理，任务结束后调用release删除
+        if self.pid != os.getpid():
+            self._start_janitor()
+        path = tempfile.mkdtemp(prefix=self.PREFIX, dir=self.spool_dir)
+        with self.lock:
+            self.busy.add(path)
+        return path
+
+    def release(self, path):
+        with self.lock:
+            self.busy.discard(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def _touch(self):
+        with self.lock:
+            busy = list(self.busy)
+        for path in busy:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    def purge(self, sec):
+        # 删除修改时间超过sec秒、且不在本进程使用中的目录；只处理本类创建的目录，spool目录指定为公共目录时不影响其他文件。
+        # sec至少为两个刷新周期，避免删除其他进程使用中的目录
+        sec = max(sec, self.interval * 2)
+        now = time.time()
+        with self.lock:
+            busy = set(self.busy)
+        try:
+            names = os.listdir(self.spool_dir)
+        except OSError:
+            return 0
+        removed = 0
+        for name in names:
+            path = os.path.join(self.spool_dir, name)
+            if not name.startswith(self.PREFIX) or path in busy:
+                continue
+            try:
+                if now - os.stat(path).st_mtime <= sec:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+        return removed
+
+    def _start_janitor(self):
+        # 清理线程在首次使用时按进程启动，preload模式下fork出的子进程也能正常工作
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            # fork前父进程使用中的目录不属于本进程
+            self.busy = set()
+        threading.Thread(target=self._janitor, daemon=True).start()
+
+    def _janitor(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._touch()
+                self.purge(self.ttl)
+            except Exception as e:
+                print(f"清理过期文件失败: {e}")
+
+    def stats(self):
+        with self.lock:
+            busy = len(self.busy)
+        try:
+            disk = sum(1 for name in os.listdir(self.spool_dir) if name.startswith(self.PREFIX))
+        except OSError:
+            disk = 0
+        return {"busy_items": busy, "disk_items": disk}
+
+
+def send_data(data, download_name):
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    return send_file(io.BytesIO(data), mimetype=mimetype, as_attachment=True, download_name=download_name)
+
+
+class ImageCache(object):
+    # 处理后图片的磁盘缓存：按字节数限制容量并按LRU淘汰，原子写入，
+    # 同一个键的并发未命中只有一个请求下载处理，其余请求等待并共享结果；
+    # 多个进程共用缓存目录时，定期重新扫描目录，容量上限对整个目录生效
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024, scan_interval=60, tmp_ttl=600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.scan_interval = scan_interval
+        self.tmp_ttl = tmp_ttl
+        self.scanned = time.time()
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._load()
+
+    def _load(self):
+        # 按修改时间(命中时会更新)恢复淘汰顺序：启动时重启前的缓存仍然有效，运行中把其他进程写入的文件计入容量
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith('.tmp'):
+                    # 其他进程可能正在写入，只清理异常退出遗留的临时文件
+                    if now - stat.st_mtime > self.tmp_ttl:
+                        os.remove(path)
+                    continue
+            except OSError:
+                # 扫描期间被其他进程淘汰或替换
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        index = OrderedDict((name, size) for _, name, size in sorted(entries))
+        with self.lock:
+            self.index = index
+            self.total_bytes = sum(index.values())
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        with self.lock:
+            found = key in self.index
+            if found:
+                self.index.move_to_end(key)
+        if found:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+                try:
+                    # 更新修改时间，重新扫描时按最近使用的顺序淘汰
+                    os.utime(self._path(key))
+                except OSError:
+                    pass
+                with self.lock:
+                    self.hits += 1
+                return data
+            except FileNotFoundError:
+                # 被共用缓存目录的其他进程淘汰
+                with self.lock:
+                    self.total_bytes -= self.index.pop(key, 0)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # 写入失败时不留下不完整的临时文件
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self.lock:
+            self.total_bytes += len(data) - self.index.pop(key, 0)
+            self.index[key] = len(data)
+            rescan = time.time() - self.scanned > self.scan_interval
+            if rescan:
+                self.scanned = time.time()
+        if rescan:
+            self._load()
+        else:
+            self._evict()
+
+    def _evict(self):
+        removed = []
+        with self.lock:
+            while self.total_bytes > self.max_bytes and self.index:
+                key, size = self.index.popitem(last=False)
+                self.total_bytes -= size
+                self.evictions += 1
+                removed.append(key)
+        for key in removed:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def join_flight(self, key):
+        # 登记对key的处理，返回(flight, leader)，leader为False时说明已有请求在处理，等待其结果即可
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = self.flights[key] = {'event': threading.Event()}
+            return flight, True
+
+    def end_flight(self, key, flight, data=None, error=None):
+        # 可重复调用，只有第一次生效；data与error都为None时等待方自行处理
+        with self.lock:
+            if flight.get('ended'):
+                return
+            flight['ended'] = True
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        try:
+            if data is not None:
+                try:
+                    self.set(key, data)
+                except OSError as e:
+                    # 写缓存失败(例如磁盘已满)不影响本次结果，等待方照常拿到data
+                    print(f"图片缓存写入失败: {e}")
+        except Exception as e:
+            # 其他异常交给等待方抛出，而不是让它们等到超时
+            error = error or e
+            raise
+        finally:
+            flight['data'] = data
+            if error is not None:
+                flight['error'] = error
+            flight['event'].set()
+
+    def get_or_create(self, key, func, timeout=60):
+        data = self.get(key)
+        if data is not None:
+            return data
+        flight, leader = self.join_flight(key)
+        if not leader:
+            # 等待超时或第一个请求没有产出结果(例如客户端断开)时自行处理
+            if flight['event'].wait(timeout):
+                if 'error' in flight:
+                    raise flight['error']
+                if flight.get('data') is not None:
+                    return flight['data']
+            return func()
+        try:
+            data = func()
+        except Exception as e:
+            self.end_flight(key, flight, error=e)
+            raise
+        self.end_flight(key, flight, data)
+        return data
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"items": len(self.index), "bytes": self.total_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                    "evictions": self.evictions, "hit_rate": round(self.hits / total, 4) if total else 0}
+
+
+def image_cache_key(op, params):
+    return hashlib.blake2b(json.dumps([op] + list(params)).encode(), digest_size=16).hexdigest() + '.img'
+
+
+def image_cache_enabled():
+    return image_cache is not None and not (has_request_context() and no_cache_requested())
+
+
+def cached_image(op, params, func):
+    # 以url与处理参数为键读取图片缓存，未开启缓存或请求指定nocache时直接处理
+    if not image_cache_enabled():
+        return func()
+    return image_cache.get_or_create(image_cache_key(op, params), func)
+
+
+IMAGE_TYPES = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp'}
+
+
+def sniff_image(data):
+    # 按文件头识别图片格式，无法识别时返回None
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def send_image(data, name):
+    # 按实际图片格式设置返回类型与文件扩展名
+    return send_data(data, name + IMAGE_TYPES.get(sniff_image(data), '.jpg'))
+
+
+class RangeIgnored(Exception):
+    # 请求了Range但上游没有返回对应的206分段内容
+    pass
+
+
+class HttpClient(object):
+    # 共享的出站HTTP客户端：按host复用长连接池，统一连接/读取超时与退避重试，
+    # 下载内容分块读取并限制大小，写入文件的下载在连接中断时按Range续传
+    def __init__(self, pool_size=32, connect_timeout=5, read_timeout=30, retries=2, max_size=50 * 1024 * 1024):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.max_size = max_size
+        self.session = requests.Session()
+        # 连接池在所有请求之间共享，不保存上游返回的cookie，避免串到其他请求
+        self.session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        retry = Retry(total=retries, backoff_factor=0.3, status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def iter_download(self, url, method='GET', max_size=None, byte_range=None, chunk_size=1 << 16, **kwargs):
+        # 流式下载，逐块返回内容；byte_range=(start, end)只下载指定范围，end为None表示到文件末尾
+        max_size = self.max_size if max_size is None else max_size
+        if byte_range is not None:
+            kwargs['headers'] = dict(kwargs.get('headers') or {})
+            kwargs['headers']['Range'] = 'bytes={}-{}'.format(byte_range[0], '' if byte_range[1] is None else byte_range[1])
+        with self.request(method, url, stream=True, **kwargs) as response:
+            if response.status_code >= 400:
+                raise Exception(f"下载失败: {response.status_code} {url}")
+            if byte_range is not None and (response.status_code != 206 or not response.headers.get(
+                    'Content-Range', '').startswith(f'bytes {byte_range[0]}-')):
+                raise RangeIgnored(f"上游未按Range返回分段内容: {response.status_code} {url}")
+            if int(response.headers.get('Content-Length') or 0) > max_size:
+                raise Exception(f"下载内容超过{max_size}字节: {url}")
+            size = 0
+            for chunk in response.iter_content(chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise Exception(f"下载内容超过{max_size}字节: {url}")
+                yield chunk
+
+    def download(self, url, method='GET', max_size=None, byte_range=None, **kwargs):
+        return b''.join(self.iter_download(url, method, max_size, byte_range, **kwargs))
+
+    def download_to(self, url, path, max_size=None, **kwargs):
+        # 下载到文件，内存占用与文件大小无关；读取中断时从已写入的位置续传，
+        # 上游不支持或忽略Range时清空文件从头下载
+        max_size = self.max_size if max_size is None else max_size
+        written = 0
+        failures = 0
+        with open(path, 'wb') as f:
+            while True:
+                remaining = max_size - written
+                if remaining <= 0:
+                    # 续传前已经写满上限，不能再以0为上限请求(0会被当作未指定而退回默认上限)
+                    raise Exception(f"下载内容超过{max_size}字节: {url}")
+                try:
+                    byte_range = (written, None) if written else None
+                    for chunk in self.iter_download(url, max_size=remaining, byte_range=byte_range, **kwargs):
+                        f.write(chunk)
+                        written += len(chunk)
+                    return written
+                except RangeIgnored as e:
+                    # 不带Range的重新下载不会再出现这种情况，不计入重试次数
+                    print(f"{e}，从头重新下载")
+                    f.seek(0)
+                    f.truncate()
+                    written = 0
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    # 响应体读到一半连接断开时为ChunkedEncodingError
+                    failures += 1
+                    if failures > self.retries:
+                        raise
+                    print(f"下载中断，从{written}字节处续传: {e}")
+                    if not self.supports_range(url, **kwargs):
+                        f.seek(0)
+                        f.truncate()
+                        written = 0
+
+    def supports_range(self, url, **kwargs):
+        try:
+            response = self.request('HEAD', url, allow_redirects=True, **kwargs)
+            return response.headers.get('Accept-Ranges') == 'bytes'
+        except requests.RequestException:
+            return False
+
+
+def cache_key(op, *imgs):
+    # 以图片内容的blake2b摘要加上操作类型、模型作为缓存键，模型由op带入(见model_op/click_op)
+    h = hashlib.blake2b(op.encode(), digest_size=16)
+    for img in imgs:
+        if isinstance(img, np.ndarray):
+            # 像素数组以类型和形状区分，避免与相同字节的图片文件冲突
+            h.update(f'{img.dtype}{img.shape}'.encode())
+            img = img.tobytes()
+        h.update(len(img).to_bytes(8, 'little'))
+        h.update(img)
+    return h.hexdigest()
+
+
+def no_cache_requested():
+    # 请求参数nocache=1或请求头Cache-Control: no-cache时跳过缓存
+    return request.args.get('nocache') in ('1', 'true') or 'no-cache' in request.headers.get('Cache-Control', '')
+
+
+def model_op(op, model):
+    # 实际使用的模型作为缓存键的一部分，未指定时为默认模型
+    return f'{op}@{server.model_key(model, op)}'
+
+
+def click_op(ocr_model, det_model):
+    # 点选验证码的缓存键同时区分OCR模型与目标检测模型
+    return f"click@{server.model_key(ocr_model, 'ocr')}/{server.model_key(det_model, 'det')}"
+
+
+def use_cache():
+    return result_cache is not None and not no_cache_requested()
 
-server = Server(ocr=args.ocr, det=args.det, old=args.old)
+
+def cached_call(op, imgs, func, enabled=None, admit=nullcontext):
+    # admit返回准入的上下文，先查缓存，未命中需要推理时才申请准入
+    if not (use_cache() if enabled is None else enabled):
+        with admit(), stage('inference'):
+            return func()
+    key = cache_key(op, *imgs)
+    result = result_cache.get(key)
+    if result is None:
+        with admit(), stage('inference'):
+            result = func()
+        result_cache.set(key, result)
+    return result
 
 
 def get_img(request, img_type='file', img_name='image'):
+    fmt = BINARY_FORMATS.get(request.mimetype)
+    if fmt is not None:
+        # Content-Type为msgpack/CBOR时图片取自请求体字典的同名字段，img_type为npy/raw时字段内容为像素数据
+        value = request_fields(fmt).get(img_name)
+        if value is None:
+            raise Exception(f"缺少{img_name}字段")
+        img = binary_image(value)
+        if img_type in PIXEL_TYPES:
+            with stage('decode'):
+                img = load_pixels(img, img_type, request.args, img_name)
+        return img
     if img_type == 'b64':
-        img = base64.b64decode(request.get_data())
-        try:  # json str of multiple images
-            dic = json.loads(img)
-            img = base64.b64decode(dic.get(img_name).encode())
-        except Exception as e:  # just base64 of single image
-            pass
+        with stage('read'):
+            data = request.get_data()
+        with stage('decode'):
+            img = base64.b64decode(data)
+            try:  # json str of multiple images
+                dic = json.loads(img)
+                img = base64.b64decode(dic.get(img_name).encode())
+            except Exception as e:  # just base64 of single image
+                pass
     if img_type == 'file':
-        img = request.files.get(img_name).read()
+        with stage('read'):
+            img = request.files.get(img_name).read()
+    if img_type in PIXEL_TYPES:
+        # 像素数据可以文件上传，也可以直接作为请求体
+        with stage('read'):
+            file = request.files.get(img_name)
+            data = file.read() if file is not None else request.get_data()
+        with stage('decode'):
+            img = load_pixels(data, img_type, request.args, img_name)
     return img
 
 
+def get_imgs(request, img_type='file', img_name='image'):
+    # 批量获取图片，file方式为同名多文件上传，b64方式为json中的base64图片列表，msgpack/CBOR请求体中为二进制列表
+    fmt = BINARY_FORMATS.get(request.mimetype)
+    if fmt is not None:
+        imgs = [binary_image(value) for value in request_fields(fmt).get(img_name) or []]
+        if img_type in PIXEL_TYPES:
+            with stage('decode'):
+                return [load_pixels(img, img_type, request.args, img_name) for img in imgs]
+        return imgs
+    if img_type == 'b64':
+        with stage('read'):
+            data = request.get_data()
+        with stage('decode'):
+            dic = json.loads(base64.b64decode(data))
+            return [base64.b64decode(img.encode()) for img in dic.get(img_name)]
+    if img_type == 'file':
+        with stage('read'):
+            return [file.read() for file in request.files.getlist(img_name)]
+    if img_type in PIXEL_TYPES:
+        with stage('read'):
+            datas = [file.read() for file in request.files.getlist(img_name)]
+        with stage('decode'):
+            return [load_pixels(data, img_type, request.args, img_name) for data in datas]
+    raise Exception(f"不支持的图片类型: {img_type}")
+
+
 def getImgContent(method, url, headers, cookies, data='', allow_redirects=True):
-    if method == 'GET':
-        response = requests.get(url=url, headers=headers, cookies=cookies, allow_redirects=allow_redirects).content
-    elif method == 'POST':
-        response = requests.post(url=url, data=data, headers=headers, cookies=cookies,
-                                 allow_redirects=allow_redirects).content
+    with stage('download'):
+        if method == 'GET':
+            response = http_client.download(url, headers=headers, cookies=cookies, allow_redirects=allow_redirects)
+        elif method == 'POST':
+            response = http_client.download(url, 'POST', data=data, headers=headers, cookies=cookies,
+                                            allow_redirects=allow_redirects)
     return response
 
 
+def get_slide_options(request):
+    # 滑块参数：scales=0.9,1,1.1 多尺度匹配；roi=x0,y0,x1,y1 或 roi=auto 限定搜索区域
+    options = {}
+    scales = request.args.get('scales')
+    if scales:
+        options['scales'] = [float(scale) for scale in scales.split(',')]
+    roi = request.args.get('roi')
+    if roi:
+        options['roi'] = roi if roi == 'auto' else [int(v) for v in roi.split(',')]
+    return options
+
+
+BINARY_FORMATS = {'application/msgpack': 'msgpack', 'application/x-msgpack': 'msgpack', 'application/cbor': 'cbor'}
+BINARY_MIMETYPES = {'msgpack': 'application/msgpack', 'cbor': 'application/cbor'}
+
+
+def dumps_json(obj):
+    # 安装了orjson时用其编码，遇到不支持的类型时退回标准库
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj)
+
+
+def binary_codec(fmt):
+    codec = msgpack if fmt == 'msgpack' else cbor2
+    if codec is None:
+        raise Exception(f"服务端未安装{'msgpack' if fmt == 'msgpack' else 'cbor2'}，不支持{fmt}格式")
+    return codec
+
+
+def binary_loads(data, fmt):
+    codec = binary_codec(fmt)
+    try:
+        return codec.unpackb(data, raw=False) if fmt == 'msgpack' else codec.loads(data)
+    except Exception as e:
+        raise Exception(f"{fmt}请求体解析失败: {str(e) or type(e).__name__}")
+
+
+def binary_dumps(obj, fmt):
+    codec = binary_codec(fmt)
+    return codec.packb(obj, use_bin_type=True) if fmt == 'msgpack' else codec.dumps(obj)
+
+
+def request_fields(fmt):
+    # msgpack/CBOR请求体为字典，图片字段直接是二进制，同一请求只解析一次
+    if 'fields' not in g:
+        with stage('read'):
+            data = request.get_data()
+        with stage('decode'):
+            fields = binary_loads(data, fmt)
+        if not isinstance(fields, dict):
+            raise Exception(f"{fmt}请求体应为字典")
+        g.fields = fields
+    return g.fields
+
+
+def binary_image(value):
+    # 图片字段为二进制，兼容传base64字符串的客户端
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    if not isinstance(value, (bytes, bytearray)):
+        raise Exception("图片字段应为二进制")
+    return bytes(value)
+
+
+def response_format(ret_type):
+    # ret_type为msgpack/cbor，或请求头Accept明确要求这两种格式时返回二进制编码，否则保持text/json
+    if ret_type in BINARY_MIMETYPES:
+        return ret_type
+    for mimetype, quality in request.accept_mimetypes:
+        if quality > 0 and mimetype in BINARY_FORMATS:
+            return BINARY_FORMATS[mimetype]
+    return None
+
+
 def set_ret(result, ret_type='text'):
+    with stage('encode'):
+        fmt = response_format(ret_type)
+        if fmt is not None:
+            if isinstance(result, Exception):
+                g.error = True
+            return Response(binary_dumps(ret_payload(result), fmt), mimetype=BINARY_MIMETYPES[fmt])
+        return _set_ret(result, ret_type)
+
+
+def ret_payload(result):
+    if isinstance(result, Exception):
+        return {"status": 200, "result": "", "msg": str(result)}
+    return {"status": 200, "result": result, "msg": ""}
+
+
+def _set_ret(result, ret_type='text'):
+    if isinstance(result, Exception) and has_request_context():
+        g.error = True
     if ret_type == 'json':
-        if isinstance(result, Exception):
-            return json.dumps({"status": 200, "result": "", "msg": str(result)})
-        else:
-            return json.dumps({"status": 200, "result": result, "msg": ""})
+        return dumps_json(ret_payload(result))
         # return json.dumps({"succ": isinstance(result, str), "result": str(result)})
     else:
         if isinstance(result, Exception):
@@ -114,18 +1946,69 @@ def set_ret(result, ret_type='text'):
             return str(result).strip()
 
 
+def set_ret_batch(results, ret_type='text'):
+    # 批量结果：json方式为逐项的result/msg列表，text方式每行一个结果
+    with stage('encode'):
+        fmt = response_format(ret_type)
+        if ret_type == 'json' or fmt is not None:
+            payload = {"status": 200, "result": [
+                {"result": "", "msg": str(r)} if isinstance(r, Exception) else {"result": r, "msg": ""}
+                for r in results], "msg": ""}
+            if fmt is not None:
+                return Response(binary_dumps(payload, fmt), mimetype=BINARY_MIMETYPES[fmt])
+            return dumps_json(payload)
+        return '\n'.join(_set_ret(r, ret_type) for r in results)
+
+
 @app.route('/<opt>/<img_type>', methods=['POST'])
 @app.route('/<opt>/<img_type>/<ret_type>', methods=['POST'])
 def ocr(opt, img_type='file', ret_type='text'):
     try:
         img = get_img(request, img_type)
+        model = request.args.get('model')
+        admit = partial(admit_request, opt)
         if opt == 'ocr':
-            result = server.classification(img)
+            result = cached_call(model_op(opt, model), [img], lambda: server.classification(img, model), admit=admit)
         elif opt == 'det':
-            result = server.detection(img)
+            result = cached_call(model_op(opt, model), [img], lambda: server.detection(img, model), admit=admit)
+        elif opt == 'click':
+            # 点选验证码：检测+识别一次完成，model为OCR模型，det_model为目标检测模型
+            det_model = request.args.get('det_model')
+            result = cached_call(click_op(model, det_model), [img], lambda: server.click(img, det_model, model),
+                                 admit=admit)
         else:
             raise f"<opt={opt}> is invalid"
         return set_ret(result, ret_type)
+    except Rejected:
+        raise
+    except Exception as e:
+        return set_ret(e, ret_type)
+
+
+@app.route('/ocr/batch/<img_type>', methods=['POST'])
+@app.route('/ocr/batch/<img_type>/<ret_type>', methods=['POST'])
+def ocr_batch(img_type='file', ret_type='text'):
+    try:
+        imgs = get_imgs(request, img_type)
+        model = request.args.get('model')
+        if use_cache():
+            keys = [cache_key(model_op('ocr', model), img) for img in imgs]
+            results = [result_cache.get(key) for key in keys]
+            missing = [i for i, r in enumerate(results) if r is None]
+            if missing:
+                # 只有未命中缓存的图片需要推理，按其数量占用并发额度
+                with admit_request('ocr', len(missing)), stage('inference'):
+                    missing_results = server.classification_batch([imgs[i] for i in missing], model)
+                for i, r in zip(missing, missing_results):
+                    results[i] = r
+                    if not isinstance(r, Exception):
+                        result_cache.set(keys[i], r)
+        else:
+            with admit_request('ocr', len(imgs)), stage('inference'):
+                results = server.classification_batch(imgs, model)
+        return set_ret_batch(results, ret_type)
+    except Rejected:
+        raise
     except Exception as e:
         return set_ret(e, ret_type)
 
@@ -136,12 +2019,189 @@ def slide(algo_type='compare', img_type='file', ret_type='text'):
     try:
         target_img = get_img(request, img_type, 'target_img')
         bg_img = get_img(request, img_type, 'bg_img')
-        result = server.slide(target_img, bg_img, algo_type)
+        options = get_slide_options(request)
+        result = cached_call(f'slide/{algo_type}/{json.dumps(options)}', [target_img, bg_img],
+                             lambda: server.slide(target_img, bg_img, algo_type, options),
+                             admit=partial(admit_request, 'slide'))
         return set_ret(result, ret_type)
+    except Rejected:
+        raise
     except Exception as e:
         return set_ret(e, ret_type)
 
 
+@app.route('/slide/<algo_type>/batch/<img_type>', methods=['POST'])
+@app.route('/slide/<algo_type>/batch/<img_type>/<ret_type>', methods=['POST'])
+def slide_batch(algo_type='compare', img_type='file', ret_type='text'):
+    try:
+        targets = get_imgs(request, img_type, 'target_img')
+        bgs = get_imgs(request, img_type, 'bg_img')
+        if len(targets) != len(bgs):
+            g.error = True
+            return jsonify({"status": 400, "result": "",
+                            "msg": f"target_img与bg_img数量不一致: {len(targets)}张滑块, {len(bgs)}张背景"}), 400
+        pairs = list(zip(targets, bgs))
+        with admit_request('slide', len(pairs)), stage('inference'):
+            results = server.slide_batch(pairs, algo_type, get_slide_options(request))
+        return set_ret_batch(results, ret_type)
+    except Rejected:
+        raise
+    except Exception as e:
+        return set_ret(e, ret_type)
+
+
+def solve_record(line, cache_enabled, admit=lambda op: nullcontext()):
+    # 处理一条NDJSON记录：{id, op, image} 或 {id, op: slide, algo_type, target_img, bg_img}，图片为base64；
+    # op为ocr/det/click，click时model为OCR模型、det_model为目标检测模型；未命中缓存的记录单独申请准入
+    record = {}
+    try:
+        record = json.loads(line)
+        op = record.get('op', 'ocr')
+        if op not in ('ocr', 'det', 'click', 'slide'):
+            raise Exception(f"不支持的操作类型: {op}")
+        result = solve_op(record, op, cache_enabled, partial(admit, op))
+        return {"id": record.get('id'), "status": 200, "result": result, "msg": ""}
+    except Exception as e:
+        return {"id": record.get('id') if isinstance(record, dict) else None,
+                "status": e.status if isinstance(e, Rejected) else 200, "result": "", "msg": str(e)}
+
+
+def solve_op(record, op, cache_enabled, admit):
+    model = record.get('model')
+    if op == 'ocr':
+        img = base64.b64decode(record['image'])
+        return cached_call(model_op(op, model), [img], lambda: server.classification(img, model), cache_enabled,
+                           admit)
+    if op == 'det':
+        img = base64.b64decode(record['image'])
+        return cached_call(model_op(op, model), [img], lambda: server.detection(img, model), cache_enabled, admit)
+    if op == 'click':
+        img = base64.b64decode(record['image'])
+        det_model = record.get('det_model')
+        return cached_call(click_op(model, det_model), [img], lambda: server.click(img, det_model, model),
+                           cache_enabled, admit)
+    algo_type = record.get('algo_type', 'compare')
+    target_img = base64.b64decode(record['target_img'])
+    bg_img = base64.b64decode(record['bg_img'])
+    return cached_call(f'slide/{algo_type}/{json.dumps({})}', [target_img, bg_img],
+                       lambda: server.slide(target_img, bg_img, algo_type), cache_enabled, admit)
+
+
+@app.route('/batch/ndjson', methods=['POST'])
+def batch_ndjson():
+    # 边接收请求体边处理，结果按完成顺序以NDJSON逐行返回
+    stream = request.stream
+    cache_enabled = use_cache()
+    # 工作线程中没有请求上下文，客户端与截止时间在这里取出
+    client, deadline = request_client(), request_deadline()
+    results = queue.Queue()
+    # 限制已读取但未处理完的记录数，处理跟不上时不再继续读取请求体
+    slots = threading.BoundedSemaphore(args.ndjson_concurrency * 2)
+    # 同一个流同时申请准入的记录数不超过准入的并发额度(及单客户端上限)，流内多出的记录在这里等待，
+    # 而不是占满全局排队队列后被自己的其他记录挤掉返回429
+    limits = [n for n in (args.max_concurrency, args.client_concurrency) if n > 0]
+    admit_slots = threading.BoundedSemaphore(min(limits)) if limits else nullcontext()
+
+    @contextmanager
+    def admit(op):
+        with admit_slots:
+            with admission.admit(op, client, deadline) if admission is not None else nullcontext():
+                yield
+
+    def work(line):
+        try:
+            results.put(solve_record(line, cache_enabled, admit))
+        finally:
+            slots.release()
+
+    def produce():
+        try:
+            with ThreadPoolExecutor(max_workers=args.ndjson_concurrency) as executor:
+                for line in iter(stream.readline, b''):
+                    if not line.strip():
+                        continue
+                    slots.acquire()
+                    executor.submit(work, line)
+        except Exception as e:
+            results.put({"id": None, "status": 200, "result": "", "msg": f"读取请求体失败: {e}"})
+        finally:
+            results.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    def generate():
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            yield dumps_json(item) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    stats = artifact_store.stats()
+    gauges = [('ocr_server_inflight_requests', metrics.inflight - 1),
+              ('ocr_server_artifacts_busy', stats['busy_items']),
+              ('ocr_server_artifacts_disk', stats['disk_items'])]
+    stats = admission.stats()
+    gauges += [('ocr_server_admission_active', sum(state['active'] for state in stats.values())),
+               ('ocr_server_admission_waiting', sum(state['waiting'] for state in stats.values()))]
+    if result_cache is not None:
+        stats = result_cache.stats()
+        gauges += [('ocr_server_result_cache_size', stats['size']),
+                   ('ocr_server_result_cache_hits', stats['hits']),
+                   ('ocr_server_result_cache_misses', stats['misses'])]
+    if image_cache is not None:
+        stats = image_cache.stats()
+        gauges += [('ocr_server_image_cache_bytes', stats['bytes']),
+                   ('ocr_server_image_cache_hits', stats['hits']),
+                   ('ocr_server_image_cache_misses', stats['misses']),
+                   ('ocr_server_image_cache_evictions', stats['evictions'])]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    # 采样分析：seconds采样时长(秒，最长60)，interval采样间隔(毫秒)，idle=1时包含空闲等待的线程；
+    # 需以--profile-token启动，并通过token参数或X-Profile-Token请求头提供相同的令牌
+    if not args.profile_token:
+        return error_ret("采样分析未开启"), 404
+    token = request.args.get('token') or request.headers.get('X-Profile-Token', '')
+    if not hmac.compare_digest(token.encode(), args.profile_token.encode()):
+        return error_ret("令牌错误"), 403
+    try:
+        seconds = min(60.0, max(0.1, float(request.args.get('seconds', 5))))
+        interval = max(1.0, float(request.args.get('interval', 10))) / 1000
+        samples, collapsed = profiler.profile(seconds, interval, request.args.get('idle') in ('1', 'true'))
+    except Exception as e:
+        return error_ret("{}".format(e))
+    return Response(collapsed, mimetype='text/plain', headers={'X-Profile-Samples': str(samples)})
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({"result": result_cache.stats() if result_cache is not None else None,
+                    "tts": tts_engine.stats(),
+                    "audio": audio_proxy.stats(),
+                    "image": image_cache.stats() if image_cache is not None else None})
+
+
+@app.route('/models', methods=['GET'])
+def models_api():
+    # 已注册的模型名称与各类型的默认模型
+    return jsonify(server.model_names())
+
+
+@app.route('/ready', methods=['GET'])
+def ready_api():
+    # 就绪检查：模型加载并预热完成后才返回200
+    if ready.is_set():
+        return "ready"
+    return "warming up", 503
+
+
 @app.route('/ping', methods=['GET'])
 def ping():
     return "pong"
@@ -176,29 +2236,160 @@ def remove_html(string):
     return regex.sub('', string)
 
 
-def createAudio(text, file_name, voiceId, rate):
-    file_name = f'{uuid.uuid4()}.mp3'
-    new_text = remove_html(text)
-    print(f"Text without html tags: {new_text}")
-    voice = getVoiceById(voiceId)
-    rate = f"+{rate}%"
-    if not voice:
-        return "error params"
+def normalize_text(text):
+    # 去掉html标签并合并空白，作为合成缓存键的一部分
+    return re.sub(r'\s+', ' ', remove_html(text)).strip()
+
+
+def cut_position(sentence, max_chars):
+    # 超长句的切分位置：优先逗号等停顿处，其次空白处，都没有时按长度截断，但不切断连续的字母数字(单词、数字)
+    for pattern, edge in ((r'[，,、：:—]+', 'end'), (r'\s+', 'start')):
+        positions = [getattr(m, edge)() for m in re.finditer(pattern, sentence[:max_chars + 1])]
+        positions = [pos for pos in positions if 0 < pos <= max_chars]
+        if positions:
+            return positions[-1]
+    pos = max_chars
+    while pos > 0 and sentence[pos - 1].isascii() and sentence[pos - 1].isalnum() \
+            and sentence[pos].isascii() and sentence[pos].isalnum():
+        pos -= 1
+    return pos or max_chars
+
+
+def split_text(text, max_chars=200):
+    # 在句末标点处切分长文本，相邻短句合并为不超过max_chars的片段，没有句末标点的超长句见cut_position
+    sentences = re.findall(r'.+?(?:[。！？!?；;…]+|\.(?=\s)|$)', text, re.S)
+    parts = []
+    for sentence in sentences:
+        while len(sentence) > max_chars:
+            pos = cut_position(sentence, max_chars)
+            parts.append(sentence[:pos])
+            sentence = sentence[pos:]
+        if parts and len(parts[-1]) + len(sentence) <= max_chars:
+            parts[-1] += sentence
+        elif sentence.strip():
+            parts.append(sentence)
+    return [part.strip() for part in parts if part.strip()]
+
+
+def iter_ordered(func, items, concurrency):
+    # 并发执行func，按items的顺序逐个返回结果，前面的片段就绪即可返回而不必等待全部完成
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = []
+    try:
+        futures = [executor.submit(func, item) for item in items]
+        for future in futures:
+            yield future.result()
+    finally:
+        # 客户端提前断开时取消尚未开始的片段(cancel_futures参数需要Python 3.9，这里逐个取消)
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def wav_stream(segments):
+    # 把多个wav片段拼接为一个流式wav：头部的长度字段按流式惯例填最大值，随后依次输出各片段的PCM数据
+    fmt = None
+    for segment in segments:
+        with wave.open(io.BytesIO(segment)) as w:
+            params = (w.getnchannels(), w.getsampwidth(), w.getframerate())
+            frames = w.readframes(w.getnframes())
+        if fmt is None:
+            fmt = params
+            channels, width, rate = params
+            yield struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 0xFFFFFFFF, b'WAVE', b'fmt ', 16, 1, channels, rate,
+                              rate * channels * width, channels * width, width * 8, b'data', 0xFFFFFFFF)
+        elif params != fmt:
+            raise Exception("语音片段格式不一致")
+        yield frames
+
+
+def stream_response(chunks, mimetype, file_name, stage_name='synthesis'):
+    # 取到第一个分片后再开始响应，合成或转换失败时仍可返回错误信息
+    try:
+        with stage(stage_name):
+            first = next(chunks)
+    except Exception as e:
+        return error_ret("{}".format(e))
+
+    def generate():
+        yield first
+        for chunk in chunks:
+            yield chunk
+
+    response = Response(generate(), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(file_name)}"})
+    if hasattr(chunks, 'close'):
+        # 响应体没有被迭代完(例如HEAD请求或客户端断开)时，也要执行生成器中的清理
+        response.call_on_close(chunks.close)
+    return response
 
-    pwdPath = os.getcwd()
-    filePath = pwdPath + "/" + file_name
-    dirPath = os.path.dirname(filePath)
-    if not os.path.exists(dirPath):
-        os.makedirs(dirPath)
-    if not os.path.exists(filePath):
-        # 用open创建文件 兼容mac
-        open(filePath, 'a').close()
 
-    script = 'edge-tts --rate=' + rate + ' --voice ' + voice + ' --text "' + new_text + '" --write-media ' + filePath
-    os.system(script)
-    # 上传到腾讯云COS云存储
-    # uploadCos(filePath, file_name)
-    return filePath
+class TTSEngine(object):
+    # 进程内的edge-tts合成引擎：在后台事件循环中合成，音频分片产生后立即交给响应流，
+    # 完整合成的结果按(规范化文本, 发音人, 语速)缓存
+    def __init__(self, cache_size=256, cache_ttl=3600, timeout=60):
+        self.cache = LRUCache(cache_size, cache_ttl) if cache_size > 0 else None
+        self.timeout = timeout
+        self.loop = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        # 事件循环线程在首次使用时按进程启动，preload模式下fork出的子进程也能正常工作
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+            self.pid = os.getpid()
+
+    async def _synthesize(self, text, voice, rate, chunks):
+        try:
+            communicate = edge_tts.Communicate(text, voice, rate=rate)
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    chunks.put(chunk["data"])
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+
+    def stream(self, text, voice, rate):
+        # 返回音频分片的迭代器，缓存命中时直接返回完整音频
+        key = (text, voice, rate)
+        if self.cache is not None:
+            audio = self.cache.get(key)
+            if audio is not None:
+                yield audio
+                return
+        if self.pid != os.getpid():
+            self._start()
+        chunks = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._synthesize(text, voice, rate, chunks), self.loop)
+        audio = []
+        try:
+            while True:
+                chunk = chunks.get(timeout=self.timeout)
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                audio.append(chunk)
+                yield chunk
+        finally:
+            # 客户端提前断开时取消合成
+            future.cancel()
+        if not audio:
+            raise Exception("语音合成结果为空")
+        if self.cache is not None:
+            self.cache.set(key, b''.join(audio))
+
+    def stats(self):
+        return self.cache.stats() if self.cache is not None else None
+
+
+def error_ret(message):
+    g.error = True
+    return jsonify({"code": "异常", "message": message})
 
 
 def getParameter(paramName):
@@ -209,74 +2400,187 @@ def getParameter(paramName):
 
 @app.route('/dealAudio', methods=['POST', 'GET'])
 def dealAudio():
-    clear_zip_file()
     text = getParameter('text')
     if len(text) <= 0:
-        return jsonify({"code": "异常", "message": "text参数不能为空"})
+        return error_ret("text参数不能为空")
     file_name = getParameter('file_name')
     if len(file_name) <= 0:
-        return jsonify({"code": "异常", "message": "filename参数不能为空"})
-    voice = getParameter('voice')
-    rate = getParameter('rate')
-    filePath = createAudio(text, file_name, voice, rate)
-    r = os.path.split(filePath)
-    print(r)
+        return error_ret("filename参数不能为空")
+    voice = getVoiceById(getParameter('voice'))
+    if not voice:
+        return error_ret("voice参数错误")
     try:
-        response = make_response(
-            send_from_directory(r[0], r[1], as_attachment=True))
-        return response
-    except Exception as e:
-        return jsonify({"code": "异常", "message": "{}".format(e)})
-
+        rate = "{:+d}%".format(int(getParameter('rate') or 0))
+    except ValueError:
+        return error_ret("rate参数错误")
+    new_text = normalize_text(text)
+    print(f"Text without html tags: {new_text}")
+    if 0 < args.tts_chunk_chars < len(new_text):
+        # 长文本按句并发合成，mp3片段按顺序直接拼接
+        chunks = iter_ordered(lambda part: b''.join(tts_engine.stream(part, voice, rate)),
+                              split_text(new_text, args.tts_chunk_chars), args.tts_concurrency)
+    else:
+        chunks = tts_engine.stream(new_text, voice, rate)
+    if not file_name.endswith('.mp3'):
+        file_name += '.mp3'
+    return stream_response(chunks, 'audio/mpeg', file_name)
+
+
+# 已经压缩过的格式再deflate收益很小，始终仅存储
+STORED_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.m4a', '.aac', '.flac', '.ogg',
+                   '.mkv', '.avi', '.mov', '.zip', '.rar', '.7z', '.gz', '.bz2', '.xz')
+
+
+class ZipStream(object):
+    # 只写的缓冲区：ZipFile写入的数据暂存在这里，由生成器逐段取出发送给客户端
+    # 不支持seek，ZipFile会以数据描述符的方式写入，无需回写文件头
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# 转发音频时的分片大小，较小的分片让客户端更早开始播放
+AUDIO_CHUNK_SIZE = 8192
+
+
+class SharedDownload(object):
+    # 进行中的上游下载：数据追加到共享缓冲区，每个等待的客户端各自从头读取，边下载边返回
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def append(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def __iter__(self):
+        pos = 0
+        while True:
+            with self.cond:
+                while pos >= len(self.chunks) and not self.done:
+                    self.cond.wait()
+                chunks = self.chunks[pos:]
+                pos += len(chunks)
+                done, error = self.done, self.error
+            for chunk in chunks:
+                yield chunk
+            if done and pos >= len(self.chunks):
+                if error is not None:
+                    raise error
+                return
+
+
+class AudioProxy(object):
+    # 语音代理：参数相同的并发请求只向上游生成一次，音频边下载边转发给所有等待的客户端，
+    # 生成完成的音频按参数缓存；上游下载在后台线程进行，不受单个客户端断开的影响
+    def __init__(self, cache_size=256, cache_ttl=3600):
+        self.cache = LRUCache(cache_size, cache_ttl) if cache_size > 0 else None
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def stream(self, key, produce):
+        # produce()返回上游音频分片的迭代器，返回值为本次请求读取音频分片的迭代器
+        if self.cache is not None:
+            data = self.cache.get(key)
+            if data is not None:
+                return iter([data])
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = SharedDownload()
+                threading.Thread(target=self._run, args=(key, flight, produce), daemon=True).start()
+            else:
+                self.coalesced += 1
+        return iter(flight)
 
-def rar2zip(rar_file):
-    rar = rarfile.RarFile(rar_file)
-    rar.extractall(os.getcwd() + '/')
-    rar.close()
-    namelist = rar.namelist()
-    print(namelist)
-    zip_file = f'{uuid.uuid4()}.zip'
-    compress_files_to_zip(namelist, zip_file)
-    for file in namelist:
-        os.remove(file)
-    os.remove(rar_file)
-    # 清除超过1天的zip文件
-    clear_zip_file()
-    return zip_file
+    def _run(self, key, flight, produce):
+        try:
+            for chunk in produce():
+                flight.append(chunk)
+        except Exception as e:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight.finish(e)
+            return
+        # 先写入缓存再移除进行中的记录，之后的请求总能命中其中之一
+        if self.cache is not None:
+            self.cache.set(key, b''.join(flight.chunks))
+        with self.lock:
+            self.flights.pop(key, None)
+        flight.finish()
+
+    def stats(self):
+        stats = self.cache.stats() if self.cache is not None else {}
+        stats['coalesced'] = self.coalesced
+        return stats
+
+
+def rar2zip(rar_file, level=0, chunk_size=1 << 16):
+    # 逐个成员流式读取rar并写入zip，zip数据边生成边返回，成员不落盘，并发任务之间也不会互相覆盖
+    out = ZipStream()
+    with rarfile.RarFile(rar_file) as rar, zipfile.ZipFile(out, 'w', compresslevel=level or None) as zf:
+        for info in rar.infolist():
+            if info.is_dir():
+                continue
+            store = level == 0 or info.filename.lower().endswith(STORED_SUFFIXES)
+            zf.compression = zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED
+            with rar.open(info) as src, \
+                    zf.open(info.filename, 'w', force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dst:
+                while True:
+                    data = src.read(chunk_size)
+                    if not data:
+                        break
+                    if store:
+                        dst.write(data)
+                    else:
+                        run_cpu(dst.write, data)
+                    if out.chunks:
+                        yield out.pop()
+    yield out.pop()
 
 
 def clear_zip_file(sec=120):
-    zip_file_list = os.listdir(os.getcwd())
-    for file in zip_file_list:
-        if file.endswith('.zip') or file.endswith('mp3') or file.endswith('jpg'):
-            zip_file_time = os.path.getmtime(file)
-            if (time.time() - zip_file_time) > sec:
-                os.remove(file)
-
-
-def compress_files_to_zip(file_paths, zip_file_path):
-    with zipfile.ZipFile(zip_file_path, 'w') as zipf:
-        for file_path in file_paths:
-            zipf.write(file_path)
+    # 删除spool目录中超过sec秒的遗留任务目录，使用中的目录不受影响
+    return artifact_store.purge(sec)
 
 
 @app.route('/rar2zip')
 def r2z():
-    clear_zip_file()
     rarurl = getParameter('rarurl')
     if len(rarurl) <= 0 or rarurl.find('http') == -1:
-        return jsonify({"code": "异常", "message": "rarurl参数异常"})
+        return error_ret("rarurl参数异常")
     filename = getParameter('filename')
     if len(filename) <= 0:
-        return jsonify({"code": "异常", "message": "filename参数不能为空"})
-    pwdPath = os.getcwd()
-    filePath = pwdPath + f"/{filename}.rar"
-    dirPath = os.path.dirname(filePath)
-    if not os.path.exists(dirPath):
-        os.makedirs(dirPath)
-    if not os.path.exists(filePath):
-        # 用open创建文件 兼容mac
-        open(filePath, 'a').close()
+        return error_ret("filename参数不能为空")
+    # 每个任务使用独立的spool目录，下载分块写入，内存占用与文件大小无关
+    job_dir = artifact_store.new_dir()
+    filePath = os.path.join(job_dir, f"{uuid.uuid4()}.rar")
 
     rarurl = quote(rarurl, safe=':/')
     print(rarurl)
@@ -284,29 +2588,32 @@ def r2z():
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
     }
-    response = requests.get(rarurl, headers=headers)
-    if response.status_code == 200:
-        with open(filePath, 'wb') as file:
-            file.write(response.content)
-        print(f"文件 {filePath} 下载成功")
-    else:
-        print("下载失败")
-
-    zipName = rar2zip(filePath)
-    r = os.path.split(filePath)
     try:
-        response = make_response(
-            send_from_directory(r[0], zipName, as_attachment=True))
-        return response
+        with stage('download'):
+            http_client.download_to(rarurl, filePath, args.spool_max_size * 1024 * 1024, headers=headers)
+        print(f"文件 {filePath} 下载成功")
     except Exception as e:
-        return jsonify({"code": "异常", "message": "{}".format(e)})
+        artifact_store.release(job_dir)
+        return error_ret("{}".format(e))
+
+    def generate():
+        try:
+            for chunk in rar2zip(filePath, args.zip_level):
+                yield chunk
+        finally:
+            artifact_store.release(job_dir)
+
+    return stream_response(generate(), 'application/zip', f'{filename}.zip', 'convert')
 
 
 @app.route('/clearzip')
 def clearzip():
     sec = getParameter('sec')
-    clear_zip_file(float(sec))
-    return f'清除超过{sec}秒的zip文件!'
+    try:
+        removed = clear_zip_file(float(sec or 120))
+    except ValueError:
+        return error_ret("sec参数异常")
+    return f'清除超过{sec or 120}秒的zip文件{removed}个!'
 
 
 @app.route('/tts')
@@ -319,7 +2626,7 @@ def genshinvoice(Text, Speaker, SDP=0.5, Noise=0.6, Noise_W=0.9, Length=1, Langu
         "referer": "https://v2.genshinvoice.top/?",
         "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
     }
-    url = "https://v2.genshinvoice.top/run/predict"
+    url = f"{args.genshin_host}/run/predict"
     data = {
         "data": [
             Text,
@@ -341,17 +2648,16 @@ def genshinvoice(Text, Speaker, SDP=0.5, Noise=0.6, Noise_W=0.9, Length=1, Langu
     }
     print(data)
     data = json.dumps(data, separators=(',', ':'))
-    response = requests.post(url, headers=headers, data=data)
-    result = response.json()
+    with stage('download'):
+        result = json.loads(http_client.download(url, 'POST', headers=headers, data=data))
     print(result)
     name = result['data'][1]['name']
-    url = 'https://v2.genshinvoice.top/file=' + name
+    url = f'{args.genshin_host}/file=' + name
     return url
 
 
 @app.route('/genshininvoice', methods=['GET', 'POST'])
 def genshininvoice_api():
-    clear_zip_file()
     # GET
     if request.method == 'GET':
         text = request.args.get('text')
@@ -363,20 +2669,23 @@ def genshininvoice_api():
         language = request.args.get('language')
         weight = request.args.get('weight')
         yuyi = request.args.get('yuyi')
-        url = genshinvoice(text, speaker, sdp, noise, noise_w, length, language, weight, yuyi)
-        res = requests.get(url)
-        file_name = f'{uuid.uuid4()}.wav'
-        pwdPath = os.getcwd()
-        filePath = pwdPath + "/" + file_name
-        with open(filePath, 'wb') as f:
-            f.write(res.content)
-        r = os.path.split(filePath)
-        try:
-            response = make_response(
-                send_from_directory(r[0], r[1], as_attachment=True))
-            return response
-        except Exception as e:
-            return jsonify({"code": "异常", "message": "{}".format(e)})
+        text = remove_html(text or '')
+        if 0 < args.tts_chunk_chars < len(text):
+            # 长文本按句并发合成，wav片段按顺序拼接为流式wav返回
+            def synthesize(part):
+                return b''.join(genshinvoice_stream(part, speaker, sdp, noise, noise_w, length, language, weight,
+                                                    yuyi))
+
+            segments = iter_ordered(synthesize, split_text(text, args.tts_chunk_chars), args.tts_concurrency)
+            return stream_response(wav_stream(segments), 'audio/wav', f'{uuid.uuid4()}.wav')
+        chunks = genshinvoice_stream(text, speaker, sdp, noise, noise_w, length, language, weight, yuyi)
+        return stream_response(chunks, 'audio/wav', f'{uuid.uuid4()}.wav', 'download')
+
+
+def genshinvoice_stream(*params):
+    # 相同参数的请求共用一次上游生成，音频边下载边返回
+    return audio_proxy.stream(('genshinvoice',) + params,
+                              lambda: http_client.iter_download(genshinvoice(*params), chunk_size=AUDIO_CHUNK_SIZE))
 
 
 def AIAudio(Text, Speaker, SDP=0.5, Noise=0.6, Noise_W=0.8, Length=1):
@@ -401,7 +2710,7 @@ def AIAudio(Text, Speaker, SDP=0.5, Noise=0.6, Noise_W=0.8, Length=1):
                 "WaiMai": "maimai-Bert-VITS2",
                 "Lumi": "Lumi-Bert-VITS2",
                 "Wenjing": "Wenjing-Bert-VITS2", "Diana": "Diana-Bert-VITS2"}
-    url = f"https://www.modelscope.cn/api/v1/studio/xzjosh/{Speakers[Speaker]}/gradio/run/predict"
+    url = f"{args.modelscope_host}/api/v1/studio/xzjosh/{Speakers[Speaker]}/gradio/run/predict"
     data = {
         "data": [
             Text,
@@ -424,16 +2733,15 @@ def AIAudio(Text, Speaker, SDP=0.5, Noise=0.6, Noise_W=0.8, Length=1):
         "session_hash": "dltfoxag7rb"
     }
     data = json.dumps(data, separators=(',', ':'))
-    response = requests.post(url, headers=headers, data=data)
-    result = response.json()
+    with stage('download'):
+        result = json.loads(http_client.download(url, 'POST', headers=headers, data=data))
     name = result['data'][1]['name']
-    audio = f'https://www.modelscope.cn/api/v1/studio/xzjosh/{Speakers[Speaker]}/gradio/file=' + name
+    audio = f'{args.modelscope_host}/api/v1/studio/xzjosh/{Speakers[Speaker]}/gradio/file=' + name
     return audio
 
 
 @app.route('/AIAudio', methods=['GET', 'POST'])
 def aiaudio_api():
-    clear_zip_file()
     # GET
     if request.method == 'GET':
         text = request.args.get('text')
@@ -442,20 +2750,10 @@ def aiaudio_api():
         noise = request.args.get('noise')
         noise_w = request.args.get('noise_w')
         length = request.args.get('length')
-        url = AIAudio(text, speaker, sdp, noise, noise_w, length)
-        res = requests.get(url)
-        file_name = f'{uuid.uuid4()}.wav'
-        pwdPath = os.getcwd()
-        filePath = pwdPath + "/" + file_name
-        with open(filePath, 'wb') as f:
-            f.write(res.content)
-        r = os.path.split(filePath)
-        try:
-            response = make_response(
-                send_from_directory(r[0], r[1], as_attachment=True))
-            return response
-        except Exception as e:
-            return jsonify({"code": "异常", "message": "{}".format(e)})
+        params = (text, speaker, sdp, noise, noise_w, length)
+        chunks = audio_proxy.stream(('AIAudio',) + params,
+                                    lambda: http_client.iter_download(AIAudio(*params), chunk_size=AUDIO_CHUNK_SIZE))
+        return stream_response(chunks, 'audio/wav', f'{uuid.uuid4()}.wav', 'download')
 
 
 def get_num(aid, index):
@@ -471,144 +2769,414 @@ def get_num(aid, index):
         normalCutNum = 2 + 2 * aIndex
     return normalCutNum
 
+def unscramble_rows(height, cut_num):
+    # 还原后每一行对应的原图行号：图片被切为cut_num段后倒序排列，第一段额外包含除不尽的余数行
+    cut_height = height // cut_num  # 分割的高度
+    unknown = height % cut_num  # 偏移高度，最后一张图的高度会比其他图高度要高
+    rows = []
+    for m in range(cut_num):
+        end_coordinate = height - cut_height * (m + 1) - unknown  # 要分割的图片底部y
+        rows.append(np.arange(end_coordinate, end_coordinate + cut_height + (unknown if m == 0 else 0)))
+    return np.concatenate(rows)
+
+
+def unscramble_image(data, aid, index):
+    # 按get_num计算的切割数还原被分段打乱的图片，在解码后的数组上一次按行重排，返回jpg图片内容
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise Exception("图片解码失败")
+    cut_num = get_num(str(aid), str(index))  # 获取分割次数
+    img = img[unscramble_rows(img.shape[0], cut_num)]
+    ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 75])
+    if not ok:
+        raise Exception("图片编码失败")
+    return buf.tobytes()
+
+
 def on_image_loaded(url):
+    return cached_image('jm', [url], lambda: load_jm_image(url))
+
+
+def load_jm_image(url):
     # aid = 421536  # 漫画id
-    outfile_name = hashlib.md5(url.encode()).hexdigest() + '.jpg'
-    if  os.path.exists(outfile_name):
-        return outfile_name
     urls = url.split('/')
     aid = urls[-2]
     img_name = urls[-1]
-    img_path = f'{uuid.uuid4()}.jpg'
-    print(img_name,img_path)
+    print(img_name)
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
     }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        with open(img_path, 'wb') as file:
-            file.write(response.content)
-        print(f"文件 {img_path} 下载成功")
-    else:
-        print(response.status_code,response.text)
-        print("下载失败")
-    img = Image.open(img_path)
-    canvas = Image.new('RGB', img.size)  # 创建一个与图片大小相同的画布
-    canvas.paste(img)  # 将图片粘贴到画布上
+    with stage('download'):
+        content = http_client.download(url, headers=headers)
+    print(f"文件 {img_name} 下载成功")
     index = img_name.split(".")[0]  # 获取图片在一组中的index，当前为00002
-    cut_num = get_num(str(aid), str(index))  # 获取分割次数
-    unknown = img.size[1] % cut_num  # 偏移高度，最后一张图的高度会比其他图高度要高
-    for m in range(cut_num):
-        cut_height = img.size[1] // cut_num  # 分割的高度
-        y_coordinate = cut_height * m  # 要分割的y坐标
-        end_coordinate = img.size[1] - cut_height * (m + 1) - unknown  # 要分割的图片底部y
-        if m == 0:
-            cut_height += unknown
-        else:
-            y_coordinate += unknown
-        region = (0, end_coordinate, img.size[0], end_coordinate + cut_height)
-        region_img = img.crop(region)
-        canvas.paste(region_img, (0, y_coordinate))
-    canvas.save(outfile_name)  # 保存处理后的图片
-    # 删除img_path文件
-    os.remove(img_path)
-    return outfile_name
+    with stage('transform'):
+        return run_cpu(unscramble_image, content, aid, index)
+
+
+def jm_page(url):
+    # 章节接口中单页的下载与还原，失败时记录错误而不中断整个章节
+    try:
+        return on_image_loaded(url), None
+    except Exception as e:
+        return None, str(e)
+
+
+def images_response(names, results, ret_format, download_name, field='name'):
+    # 按顺序返回批量处理的图片，results为与names一一对应的(data, error)；
+    # zip为边生成边发送的压缩包，失败项记录在errors.json中；ndjson逐行返回base64图片
+    if ret_format == 'ndjson':
+        def generate():
+            for name, (data, error) in zip(names, results):
+                item = {field: name, "image": base64.b64encode(data).decode() if data else "", "msg": error or ""}
+                yield json.dumps(item) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    def generate():
+        out = ZipStream()
+        errors = {}
+        with zipfile.ZipFile(out, 'w') as zf:
+            for name, (data, error) in zip(names, results):
+                if error:
+                    errors[name] = error
+                else:
+                    zf.writestr(name + IMAGE_TYPES.get(sniff_image(data), '.jpg'), data)
+                yield out.pop()
+            if errors:
+                zf.writestr('errors.json', json.dumps(errors, ensure_ascii=False))
+        yield out.pop()
+
+    return stream_response(generate(), 'application/zip', download_name, 'download')
+
+
+JM_EXTS = ('jpg', 'jpeg', 'webp', 'png', 'gif')
+
+
+def parse_pages(pages):
+    # 页码列表：1-20,25 或 00001,00002(也可以带扩展名00001.webp)，数字页码补齐为5位
+    result = []
+    for item in pages.split(','):
+        item = item.strip()
+        if re.fullmatch(r'\d+-\d+', item):
+            start, end = item.split('-')
+            result += [f'{page:05d}' for page in range(int(start), int(end) + 1)]
+        elif item.isdigit():
+            result.append(f'{int(item):05d}')
+        elif item:
+            result.append(item)
+    return result
+
+
+def save_decrypted_image(plain):
+    # 解密结果不是可识别的图片格式时，用PIL转为jpg
+    image = Image.open(io.BytesIO(plain))
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+def iter_decrypt(cipher, chunks):
+    # 边下载边按块对齐增量解密，最后一个块留到结束时处理，去掉其中合法的PKCS7填充
+    block_size = AES.block_size
+    buf = b''
+    for chunk in chunks:
+        buf += chunk
+        n = (len(buf) // block_size - 1) * block_size
+        if n > 0:
+            yield cipher.decrypt(buf[:n])
+            buf = buf[n:]
+    if len(buf) % block_size:
+        raise Exception("密文长度不是AES块大小的整数倍")
+    last = cipher.decrypt(buf)
+    try:
+        last = unpad(last, block_size)
+    except ValueError:
+        pass
+    yield last
+
+
+def decrypted_image(cipher, res):
+    # 解密结果已经是jpg/png/gif/webp时原样返回，否则转为jpg
+    plain = b''.join(iter_decrypt(cipher, [res]))
+    if sniff_image(plain):
+        return plain
+    return save_decrypted_image(plain)
+
+
+def stream_decrypted_image(op, params, url, cipher, name):
+    # 边下载边解密，识别出图片格式后直接把明文流式返回，同时写入图片缓存；
+    # 同一图片的并发请求等待第一个请求的结果，无法识别的格式退回PIL转为jpg
+    key = image_cache_key(op, params)
+    flight = None
+    # HEAD请求的响应体不会被读取，不参与缓存
+    if image_cache_enabled() and request.method != 'HEAD':
+        data = image_cache.get(key)
+        if data is not None:
+            return send_image(data, name)
+        flight, leader = image_cache.join_flight(key)
+        if not leader:
+            # 第一个请求的客户端断开或失败时，等待方自行下载
+            flight['event'].wait(60)
+            if flight.get('data') is not None:
+                return send_image(flight['data'], name)
+            flight = None
+
+    def fail(e):
+        if flight is not None:
+            image_cache.end_flight(key, flight, error=e)
+        return error_ret("{}".format(e))
+
+    chunks = iter_decrypt(cipher, http_client.iter_download(url))
+    head = b''
+    try:
+        with stage('download'):
+            for chunk in chunks:
+                head += chunk
+                if len(head) >= 12:
+                    break
+    except Exception as e:
+        return fail(e)
+    mimetype = sniff_image(head)
+    if mimetype is None:
+        try:
+            with stage('decrypt'):
+                data = run_cpu(save_decrypted_image, head + b''.join(chunks))
+        except Exception as e:
+            return fail(e)
+        if flight is not None:
+            image_cache.end_flight(key, flight, data)
+        return send_data(data, name + '.jpg')
+
+    def generate():
+        parts = [head]
+        try:
+            yield head
+            for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+        except Exception as e:
+            if flight is not None:
+                image_cache.end_flight(key, flight, error=e)
+            raise
+        if flight is not None:
+            image_cache.end_flight(key, flight, b''.join(parts))
+
+    response = Response(generate(), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename={name}{IMAGE_TYPES[mimetype]}"})
+    if flight is not None:
+        # 客户端中途断开或响应体没有被迭代时，结束登记让等待方自行下载
+        response.call_on_close(lambda: image_cache.end_flight(key, flight))
+    return response
+
+
+CG_MEDIA_KEY = b'f5d965df75336270'
+CG_MEDIA_IV = b'97b60394abc2fbe1'
 
 
 def decrypt_image(url):
-    out_path = f'{uuid.uuid4()}.jpg'
-    response = requests.get(url)
-    res = response.content
-    media_key = b'f5d965df75336270'
-    media_iv = b'97b60394abc2fbe1'
-    cipher = AES.new(media_key, AES.MODE_CBC, iv=media_iv)
-    decrypted_bytes = cipher.decrypt(res)
-    image = Image.open(io.BytesIO(decrypted_bytes))
-    image.save(out_path)
-    return out_path
+    return cached_image('51cg', [url], lambda: load_decrypted_image(url))
+
+
+def load_decrypted_image(url):
+    with stage('download'):
+        res = http_client.download(url)
+    cipher = AES.new(CG_MEDIA_KEY, AES.MODE_CBC, iv=CG_MEDIA_IV)
+    with stage('decrypt'):
+        return run_cpu(decrypted_image, cipher, res)
 @app.route('/51cg', methods=['GET', 'POST'])
 def cg_decrypt_image():
     url = getParameter('url')
     if len(url) <= 0:
-        return jsonify({"code": "异常", "message": "url参数不能为空"})
-    out_path = decrypt_image(url)
-    r = os.path.split(out_path)
+        return error_ret("url参数不能为空")
     try:
-        response = make_response(
-            send_from_directory(r[0], out_path, as_attachment=True))
-        return response
+        cipher = AES.new(CG_MEDIA_KEY, AES.MODE_CBC, iv=CG_MEDIA_IV)
+        return stream_decrypted_image('51cg', [url], url, cipher, hashlib.md5(url.encode()).hexdigest())
     except Exception as e:
-        return jsonify({"code": "异常", "message": "{}".format(e)})
+        return error_ret("{}".format(e))
 
 
 @app.route('/jm', methods=['GET', 'POST'])
 def jm():
     url = getParameter('url')
     if len(url) <= 0:
-        return jsonify({"code": "异常", "message": "url参数不能为空"})
-    outfile = on_image_loaded(url)
-    r = os.path.split(outfile)
+        return error_ret("url参数不能为空")
     try:
-        response = make_response(
-            send_from_directory(r[0], outfile, as_attachment=True))
-        return response
+        return send_data(on_image_loaded(url), hashlib.md5(url.encode()).hexdigest() + '.jpg')
     except Exception as e:
-        return jsonify({"code": "异常", "message": "{}".format(e)})
+        return error_ret("{}".format(e))
+@app.route('/jm/chapter', methods=['GET', 'POST'])
+def jm_chapter():
+    # 整章下载：base为图片地址前缀(到/media/photos)，按aid与页码并发下载还原，
+    # ext为图片地址的扩展名(jpg/webp/png/gif，默认jpg)，页码也可以直接带扩展名(00001.webp)；
+    # format=zip(默认)返回边生成边发送的zip，format=ndjson逐行返回base64图片
+    base = getParameter('base').rstrip('/')
+    if len(base) <= 0 or base.find('http') == -1:
+        return error_ret("base参数异常")
+    aid = getParameter('aid')
+    if not aid.isdigit():
+        return error_ret("aid参数异常")
+    pages = parse_pages(getParameter('pages'))
+    if not pages:
+        return error_ret("pages参数不能为空")
+    ret_format = getParameter('format') or 'zip'
+    if ret_format not in ('zip', 'ndjson'):
+        return error_ret("format参数异常")
+    ext = (getParameter('ext') or 'jpg').lstrip('.').lower()
+    if ext not in JM_EXTS:
+        return error_ret("ext参数异常")
+    urls = [f'{base}/{aid}/{page}' if '.' in page else f'{base}/{aid}/{page}.{ext}' for page in pages]
+    results = iter_ordered(jm_page, urls, args.jm_concurrency)
+    return images_response([page.split('.')[0] for page in pages], results, ret_format, f'{aid}.zip', 'page')
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     return 'OK'
 def aesDecryptImg(url,key,iv,mode):
-    out_path = f'{uuid.uuid4()}.jpg'
-    response = requests.get(url)
-    res = response.content
+    return cached_image('aes', [url, key, iv, mode], lambda: load_aes_image(url, key, iv, mode))
+
+
+def load_aes_image(url,key,iv,mode):
+    with stage('download'):
+        res = http_client.download(url)
     key = key.encode('utf-8')
     iv = iv.encode('utf-8')
     if mode == 'CBC':
         mode = AES.MODE_CBC
         try:
             cipher = AES.new(key, mode, iv=iv)
-            decrypted_bytes = cipher.decrypt(res)
-            image = Image.open(io.BytesIO(decrypted_bytes))
-            image.save(out_path)
+            with stage('decrypt'):
+                data = run_cpu(decrypted_image, cipher, res)
             print("Image decrypted successfully!")
-            return out_path
+            return data
         except Exception as e:
             print(f"Error decrypting image: {e}")
     elif mode == 'ECB':
         mode = AES.MODE_ECB
         cipher = AES.new(key, mode)
-        decrypted_bytes = cipher.decrypt(base64.b64decode(res))
+        with stage('decrypt'):
+            decrypted_bytes = run_cpu(cipher.decrypt, base64.b64decode(res))
         decrypted_data = unpad(decrypted_bytes, AES.block_size).decode('utf-8').split(',')[1]
-        decrypted_data = base64.b64decode(decrypted_data)
-        # 保存为文件,实现这里
-        with open(out_path, 'wb') as file:
-            file.write(decrypted_data)
-        return out_path
+        return base64.b64decode(decrypted_data)
     else:
         print("Invalid mode specified. Please use 'ECB' or 'CBC'.")
 @app.route('/aesDecryptImg', methods=['GET', 'POST'])
 def decryptImg():
     url = getParameter('url')
     if len(url) <= 0:
-        return jsonify({"code": "异常", "message": "url参数不能为空"})
+        return error_ret("url参数不能为空")
     key = getParameter('key')
     if len(key) <= 0:
-        return jsonify({"code": "异常", "message": "key参数不能为空"})
+        return error_ret("key参数不能为空")
     iv = getParameter('iv')
     if len(iv) <= 0:
-        return jsonify({"code": "异常", "message": "iv参数不能为空"})
+        return error_ret("iv参数不能为空")
     mode = getParameter('mode')
     if len(mode) <= 0:
-        return jsonify({"code": "异常", "message": "mode参数不能为空"})
-    out_path = aesDecryptImg(url,key, iv, mode)
-    r = os.path.split(out_path)
+        return error_ret("mode参数不能为空")
+    name = hashlib.md5(url.encode()).hexdigest()
+    try:
+        if mode == 'CBC':
+            cipher = AES.new(key.encode('utf-8'), AES.MODE_CBC, iv=iv.encode('utf-8'))
+            return stream_decrypted_image('aes', [url, key, iv, mode], url, cipher, name)
+        data = aesDecryptImg(url,key, iv, mode)
+        if data is None:
+            return error_ret("图片解密失败")
+        return send_image(data, name)
+    except Exception as e:
+        return error_ret("{}".format(e))
+
+
+@app.route('/aesDecryptImg/batch', methods=['GET', 'POST'])
+def decryptImgBatch():
+    # 批量解密：多个url共用key/iv/mode，并发下载解密，按url顺序返回zip或ndjson
+    # url可以通过多个url参数传入，也可以POST json：{"urls": [...], "key": ..., "iv": ..., "mode": ..., "format": ...}
+    params = request.get_json(silent=True) if request.method == 'POST' else None
+    params = params if isinstance(params, dict) else {}
+    urls = params.get('urls') or request.args.getlist('url') or request.form.getlist('url')
+    if not urls:
+        return error_ret("url参数不能为空")
+    key = params.get('key') or getParameter('key')
+    if len(key) <= 0:
+        return error_ret("key参数不能为空")
+    iv = params.get('iv') or getParameter('iv')
+    mode = params.get('mode') or getParameter('mode')
+    if mode not in ('CBC', 'ECB'):
+        return error_ret("mode参数异常")
+    if mode == 'CBC' and len(iv) <= 0:
+        return error_ret("iv参数不能为空")
+    ret_format = params.get('format') or getParameter('format') or 'zip'
+    if ret_format not in ('zip', 'ndjson'):
+        return error_ret("format参数异常")
+
+    def decrypt(url):
+        try:
+            data = aesDecryptImg(url, key, iv, mode)
+            if data is None:
+                return None, "图片解密失败"
+            return data, None
+        except Exception as e:
+            return None, str(e)
+
+    names = [f'{i:04d}' for i in range(1, len(urls) + 1)]
+    results = iter_ordered(decrypt, urls, args.aes_concurrency)
+    return images_response(names, results, ret_format, f'{uuid.uuid4()}.zip')
+
+
+def warmup():
+    start = time.time()
     try:
-        response = make_response(
-            send_from_directory(r[0], out_path, as_attachment=True))
-        return response
+        server.warmup()
+        print(f"模型预热完成，耗时{time.time() - start:.2f}秒")
     except Exception as e:
-        return jsonify({"code": "异常", "message": "{}".format(e)})
+        print(f"模型预热失败: {e}")
+    ready.set()
+
+
+def create_app(argv=None):
+    # 应用工厂：解析参数、按加载方式初始化模型并返回app
+    # argv可以是参数列表或字符串，不传时读取环境变量OCR_SERVER_ARGS，例如用于gunicorn：
+    # gunicorn -w 4 --preload -b 0.0.0.0:9898 "ocr_server:create_app('--ocr --det --load-mode preload')"
+    global args, cpu_pool, server, result_cache, artifact_store, tts_engine, http_client, image_cache, audio_proxy, \
+        admission
+    if argv is None:
+        argv = os.environ.get('OCR_SERVER_ARGS', '')
+    if isinstance(argv, str):
+        argv = argv.split()
+    args = parser.parse_args(argv)
+    if args.workers > 0 and args.load_mode == 'preload':
+        parser.error("--workers不能与--load-mode preload同时使用")
+    if args.async_mode:
+        from gevent.threadpool import ThreadPool
+
+        cpu_pool = ThreadPool(args.cpu_threads)
+    if args.cache_size > 0:
+        result_cache = ResultCache(args.cache_size, args.cache_ttl, args.cache_dir)
+    artifact_store = ArtifactStore(args.spool_dir, args.artifact_ttl)
+    tts_engine = TTSEngine(args.tts_cache_size, args.tts_cache_ttl)
+    audio_proxy = AudioProxy(args.audio_cache_size, args.audio_cache_ttl)
+    admission = AdmissionControl(args.max_concurrency, args.max_queue, args.client_concurrency)
+    if args.image_cache_size > 0:
+        image_cache = ImageCache(args.image_cache_dir, args.image_cache_size * 1024 * 1024)
+    http_client = HttpClient(args.http_pool_size, args.http_connect_timeout, args.http_read_timeout,
+                             args.http_retries, args.http_max_size * 1024 * 1024)
+    server = build_server(args)
+    if args.load_mode == 'lazy':
+        ready.set()
+    elif args.load_mode == 'preload':
+        warmup()
+    else:
+        threading.Thread(target=warmup, daemon=True).start()
+    return app
 
 
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=args.port)
+    create_app(sys.argv[1:])
+    if args.async_mode:
+        from gevent.pywsgi import WSGIServer
+
+        print(f"gevent异步模式启动，识别线程数{args.cpu_threads}")
+        WSGIServer(("0.0.0.0", args.port), app).serve_forever()
+    else:
+        app.run(host="0.0.0.0", port=args.port)
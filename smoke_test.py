@@ -0,0 +1,83 @@
+# encoding=utf-8
+# 启动参数组合的冒烟测试：逐个以子进程启动服务，等待/ready后调用识别接口，确认推理进程与异步模式等组合可用
+# python smoke_test.py
+# python smoke_test.py --combos "--ocr --det --workers 2 --async"
+import argparse
+import io
+import subprocess
+import sys
+import time
+
+import numpy as np
+import requests
+from PIL import Image
+
+COMBOS = [
+    '--ocr --det',
+    '--ocr --det --async',
+    '--ocr --det --workers 2',
+    '--ocr --det --workers 2 --async',
+]
+
+
+def large_image():
+    # 超过管道缓冲区大小的图片，确认主进程向推理进程发送大数据时不会出错
+    pixels = np.random.RandomState(0).randint(0, 255, (1200, 1600, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def check(host, img, big):
+    for path in ('/ocr/file/json', '/det/file/json'):
+        ret = requests.post(host + path, files={'image': img}, timeout=60).json()
+        assert ret['status'] == 200 and not ret['msg'] and ret['result'], f"{path}: {ret}"
+    ret = requests.post(host + '/ocr/file/json', files={'image': big}, timeout=60).json()
+    assert ret['status'] == 200 and not ret['msg'], f"大图: {ret}"
+    ret = requests.post(host + '/ocr/batch/file/json', files=[('image', img)] * 4, timeout=60).json()
+    assert all(item['result'] and not item['msg'] for item in ret['result']), f"批量: {ret}"
+
+
+def run(combo, port, img, big):
+    host = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen([sys.executable, 'ocr_server.py', '--port', str(port)] + combo.split(),
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.time() + 120
+        while True:
+            if process.poll() is not None:
+                raise Exception(f"服务启动失败: {process.stdout.read().decode(errors='replace')[-2000:]}")
+            try:
+                if requests.get(host + '/ready', timeout=1).status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            if time.time() > deadline:
+                raise Exception("等待服务就绪超时")
+            time.sleep(0.5)
+        check(host, img, big)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ocr_api_server启动参数组合冒烟测试")
+    parser.add_argument('--combos', action='append', help="要测试的参数组合，可重复指定，默认测试全部组合")
+    parser.add_argument('--port', type=int, default=9961)
+    opts = parser.parse_args()
+    img = open('test.jpg', 'rb').read()
+    big = large_image()
+    failed = 0
+    for combo in opts.combos or COMBOS:
+        try:
+            run(combo, opts.port, img, big)
+            print(f"通过  {combo}")
+        except Exception as e:
+            failed += 1
+            print(f"失败  {combo}: {e}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
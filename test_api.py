@@ -8,8 +8,11 @@
 # @File    : test_api.py
 # @Software: PyCharm
 import base64
+import io
 import json
+import numpy as np
 import requests
+from PIL import Image
 
 print(' ')
 # ******************OCR识别部分开始******************
@@ -44,6 +47,43 @@ api_url = f"{host}/det/file/json"
 resp = requests.post(api_url, files={'image': file})
 print(f"{api_url=}, {resp.text=}")
 
+api_url = f"{host}/ocr/batch/file/json"
+resp = requests.post(api_url, files=[('image', file), ('image', file)])
+print(f"{api_url=}, {resp.text=}")
+
+api_url = f"{host}/ocr/batch/b64"
+jsonstr = json.dumps({'image': [base64.b64encode(file).decode()] * 2})
+resp = requests.post(api_url, data=base64.b64encode(jsonstr.encode()).decode())
+print(f"{api_url=}, {resp.text=}")
+
+# msgpack/CBOR编码的请求与返回，图片字段直接是二进制，服务端需安装msgpack/cbor2
+try:
+    import msgpack
+
+    api_url = f"{host}/ocr/file/msgpack"
+    resp = requests.post(api_url, data=msgpack.packb({'image': file}), headers={'Content-Type': 'application/msgpack'})
+    print(f"{api_url=}, {msgpack.unpackb(resp.content)=}")
+except ImportError:
+    pass
+
+# 点选验证码：检测与识别一次完成，返回每个文字框的坐标和识别结果
+api_url = f"{host}/click/file/json"
+resp = requests.post(api_url, files={'image': file})
+print(f"{api_url=}, {resp.text=}")
+
+# 已解码的像素数据，跳过图片解码：npy数组文件，或原始像素加width/height/mode参数
+pixels = np.asarray(Image.open(io.BytesIO(file)).convert('RGB'))
+npy = io.BytesIO()
+np.save(npy, pixels)
+
+api_url = f"{host}/ocr/npy"
+resp = requests.post(api_url, files={'image': npy.getvalue()})
+print(f"{api_url=}, {resp.text=}")
+
+api_url = f"{host}/det/raw/json?width={pixels.shape[1]}&height={pixels.shape[0]}&mode=RGB"
+resp = requests.post(api_url, data=pixels.tobytes())
+print(f"{api_url=}, {resp.text=}")
+
 # 滑块识别
 
 target_file = open(r'match_target.png', 'rb').read()
@@ -68,6 +108,14 @@ api_url = f"{host}/slide/match/b64/json"
 resp = requests.post(api_url, data=base64.b64encode(jsonstr.encode()).decode())
 print(f"{api_url=}, {resp.text=}")
 
+api_url = f"{host}/slide/match/file/json?roi=auto&scales=0.95,1,1.05"
+resp = requests.post(api_url, files={'target_img': target_file, 'bg_img': bg_file})
+print(f"{api_url=}, {resp.text=}")
+
+api_url = f"{host}/slide/match/batch/file/json"
+resp = requests.post(api_url, files=[('target_img', target_file), ('bg_img', bg_file)] * 2)
+print(f"{api_url=}, {resp.text=}")
+
 target_file = open(r'compare_target.jpg', 'rb').read()
 bg_file = open(r'compare_bg.jpg', 'rb').read()
 